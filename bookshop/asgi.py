@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookshop.settings')
+os.environ.setdefault('ASYNC_VIEWS', '1')
+# Под ASGI синхронный код каждого запроса выполняется в новом потоке, постоянные
+# соединения потоков не переиспользуются и только копятся; переиспользование дает DB_POOL=1
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
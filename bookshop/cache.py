@@ -0,0 +1,281 @@
+"""
+Двухуровневый кэш: LRU в памяти процесса (L1) перед общим кэшем.
+
+Запись идет в общий кэш и публикует там сообщение об инвалидации. Каждый
+процесс читает лог сообщений не чаще раза в INVALIDATION_INTERVAL секунд и
+выкидывает из L1 ключи, измененные другими процессами, поэтому частые чтения
+обслуживаются из памяти процесса без обращения к общему кэшу.
+
+Django создает экземпляр бэкенда на каждый поток, поэтому L1 и позиция в логе
+хранятся на уровне модуля, общие для всех потоков процесса (по LOCATION, по
+умолчанию - алиас общего кэша), и сбрасываются после fork.
+
+Запись стоит двух лишних обращений к общему кэшу (incr номера в логе и само
+сообщение). Лог полагается на атомарный incr, который есть у Redis; файловый
+и БД-бэкенды делают incr через get+set, и при одновременной записи двух
+процессов сообщение может потеряться. Потерянное сообщение оставляет
+устаревшую копию в L1 не дольше L1_TIMEOUT секунд; если это важно, нужен Redis.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'bookshop.cache.TieredCache',
+            'OPTIONS': {'SHARED': 'shared', 'L1_MAX_ENTRIES': 1000, 'L1_TIMEOUT': 5},
+        },
+        'shared': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', ...},
+    }
+"""
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+MISSING = object()
+SEQUENCE_KEY = 'tiered:invalidation:seq'
+MESSAGE_KEY = 'tiered:invalidation:%d'
+FLUSH_ALL = '*'
+
+# Счетчики попаданий текущего запроса: в словаре, положенном сюда (например,
+# middleware метрик), растут те же ключи, что и в TieredCache.stats
+request_stats = ContextVar('tiered_cache_request_stats', default=None)
+
+
+class ProcessState:
+    """L1 и позиция в логе инвалидаций текущего процесса"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.origin = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.l1 = OrderedDict()
+        self.seen = None
+        self.next_sync = 0
+        self.stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0}
+
+
+_processes = {}
+_processes_lock = threading.Lock()
+
+
+def get_process_state(name):
+    with _processes_lock:
+        state = _processes.get(name)
+        # Дочерний процесс после fork не должен унаследовать L1 и origin родителя
+        if state is None or state.pid != os.getpid():
+            state = _processes[name] = ProcessState()
+        return state
+
+
+class TieredCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options.get('SHARED', 'shared')
+        self._l1_max_entries = int(options.get('L1_MAX_ENTRIES', 1000))
+        self._l1_timeout = float(options.get('L1_TIMEOUT', 5))
+        self._interval = float(options.get('INVALIDATION_INTERVAL', 1))
+        self._message_timeout = int(options.get('INVALIDATION_LOG_TIMEOUT', 300))
+        self._name = location or self._shared_alias
+        self._state = get_process_state(self._name)
+
+    @property
+    def state(self):
+        state = self._state
+        if state.pid != os.getpid():
+            state = self._state = get_process_state(self._name)
+        return state
+
+    @property
+    def stats(self):
+        return self.state.stats
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def _count(self, name):
+        state = self.state
+        with state.lock:
+            state.stats[name] += 1
+        stats = request_stats.get()
+        if stats is not None:
+            stats[name] = stats.get(name, 0) + 1
+
+    # L1
+
+    def _l1_get(self, key):
+        state = self.state
+        with state.lock:
+            entry = state.l1.get(key)
+            if entry is None:
+                return MISSING
+            expires, pickled = entry
+            if expires <= time.monotonic():
+                del state.l1[key]
+                return MISSING
+            state.l1.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def _l1_set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        ttl = self._l1_timeout
+        if timeout is not DEFAULT_TIMEOUT and timeout is not None:
+            ttl = min(ttl, timeout)
+        if ttl <= 0:
+            self._l1_evict([key])
+            return
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        state = self.state
+        with state.lock:
+            state.l1[key] = (time.monotonic() + ttl, pickled)
+            state.l1.move_to_end(key)
+            while len(state.l1) > self._l1_max_entries:
+                state.l1.popitem(last=False)
+
+    def _l1_evict(self, keys):
+        state = self.state
+        with state.lock:
+            if FLUSH_ALL in keys:
+                state.l1.clear()
+                return
+            for key in keys:
+                state.l1.pop(key, None)
+
+    # Лог инвалидаций
+
+    def _next_sequence(self, shared):
+        try:
+            return shared.incr(SEQUENCE_KEY)
+        except ValueError:
+            # Первая запись после очистки общего кэша
+            shared.add(SEQUENCE_KEY, 0, None)
+            return shared.incr(SEQUENCE_KEY)
+
+    def _publish(self, keys):
+        self._l1_evict(keys)
+        shared = self.shared
+        message = (self.state.origin, list(keys))
+        # add, а не set: при неатомарном incr номер может достаться двоим,
+        # и второй не должен затереть сообщение первого
+        while not shared.add(MESSAGE_KEY % self._next_sequence(shared), message, self._message_timeout):
+            pass
+
+    def _sync(self):
+        state = self.state
+        now = time.monotonic()
+        with state.lock:
+            if now < state.next_sync:
+                return
+            # Лог за интервал читает один поток, остальные продолжают отдавать L1
+            state.next_sync = now + self._interval
+            seen = state.seen
+        seq = self.shared.get(SEQUENCE_KEY)
+        if seq is None or seen is None or seq < seen:
+            # Лог потерян или процесс только стартовал: чужих изменений не знаем
+            if seen is not None:
+                self._l1_evict([FLUSH_ALL])
+            state.seen = seq or 0
+            return
+        if seq == seen:
+            return
+        wanted = [MESSAGE_KEY % n for n in range(seen + 1, seq + 1)]
+        messages = self.shared.get_many(wanted)
+        if len(messages) < len(wanted):
+            self._l1_evict([FLUSH_ALL])
+        else:
+            for origin, keys in messages.values():
+                if origin != state.origin:
+                    self._l1_evict(keys)
+        state.seen = seq
+
+    # API кэша
+
+    def get(self, key, default=None, version=None):
+        made_key = self.make_and_validate_key(key, version=version)
+        self._sync()
+        value = self._l1_get(made_key)
+        if value is not MISSING:
+            self._count('l1_hits')
+            return value
+        value = self.shared.get(key, MISSING, version=version)
+        if value is MISSING:
+            self._count('misses')
+            return default
+        self._count('l2_hits')
+        self._l1_set(made_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        # Сначала L1, промахи - одним get_many к общему кэшу
+        self._sync()
+        found, missed = {}, []
+        for key in keys:
+            value = self._l1_get(self.make_and_validate_key(key, version=version))
+            if value is MISSING:
+                missed.append(key)
+            else:
+                self._count('l1_hits')
+                found[key] = value
+        if not missed:
+            return found
+        shared_found = self.shared.get_many(missed, version=version)
+        for key in missed:
+            if key in shared_found:
+                self._count('l2_hits')
+                self._l1_set(self.make_and_validate_key(key, version=version), shared_found[key])
+            else:
+                self._count('misses')
+        found.update(shared_found)
+        return found
+
+    def has_key(self, key, version=None):
+        return self.get(key, MISSING, version=version) is not MISSING
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        made_key = self.make_and_validate_key(key, version=version)
+        self.shared.set(key, value, timeout, version=version)
+        self._publish([made_key])
+        self._l1_set(made_key, value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout, version=version)
+        self._publish([self.make_and_validate_key(key, version=version) for key in data])
+        for key, value in data.items():
+            if key not in failed:
+                self._l1_set(self.make_and_validate_key(key, version=version), value, timeout)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version=version)
+        if added:
+            made_key = self.make_and_validate_key(key, version=version)
+            self._publish([made_key])
+            self._l1_set(made_key, value, timeout)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self.shared.incr(key, delta, version=version)
+        self._publish([self.make_and_validate_key(key, version=version)])
+        return value
+
+    def delete(self, key, version=None):
+        deleted = self.shared.delete(key, version=version)
+        self._publish([self.make_and_validate_key(key, version=version)])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self.shared.delete_many(keys, version=version)
+        self._publish([self.make_and_validate_key(key, version=version) for key in keys])
+
+    def clear(self):
+        self.shared.clear()
+        self._publish([FLUSH_ALL])
@@ -0,0 +1,50 @@
+"""
+MySQL-бэкенд, который берет соединения из общего пула процесса.
+
+    DATABASES['default'] = {
+        'ENGINE': 'bookshop.db.mysql_pool',
+        'CONN_MAX_AGE': 0,  # "закрытие" возвращает соединение в пул
+        'POOL': {'SIZE': 10, 'TIMEOUT': 5, 'HEALTH_CHECK_INTERVAL': 30},
+        ...
+    }
+"""
+from django.db import OperationalError
+from django.db.backends.mysql import base as mysql
+
+from .pool import ConnectionPool, PoolTimeout, find_pool, get_pool
+
+
+class DatabaseWrapper(mysql.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fresh_connection = False
+
+    def get_pool(self, conn_params):
+        options = self.settings_dict.get('POOL', {})
+        return get_pool(self.alias, lambda: ConnectionPool(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+            size=int(options.get('SIZE', 10)),
+            timeout=float(options.get('TIMEOUT', 5)),
+            health_check_interval=float(options.get('HEALTH_CHECK_INTERVAL', 30)),
+        ))
+
+    def get_new_connection(self, conn_params):
+        try:
+            connection, self._fresh_connection = self.get_pool(conn_params).acquire()
+        except PoolTimeout as e:
+            raise OperationalError(f'{self.alias}: {e}') from e
+        return connection
+
+    def init_connection_state(self):
+        # Переменные сессии живут на соединении из пула, задаются один раз
+        if self._fresh_connection:
+            super().init_connection_state()
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool = find_pool(self.alias)
+        if pool is None:
+            return super()._close()
+        pool.release(self.connection, broken=self.errors_occurred and not self.is_usable())
@@ -0,0 +1,136 @@
+"""
+Общий для процесса пул DB-API соединений.
+
+Django держит по соединению на поток; под ASGI синхронный код каждого запроса
+выполняется в новом потоке, так что ни CONN_MAX_AGE, ни кэш по потокам не
+переиспользуют соединения. Пул отдает соединение любому потоку, который его
+просит, и забирает обратно, когда Django "закрывает" свою обертку.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, size=10, timeout=5.0, health_check_interval=30.0,
+                 ping=None, reset=None, close=None):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.ping = ping or (lambda conn: conn.ping())
+        self.reset = reset or (lambda conn: conn.rollback())
+        self.close = close or (lambda conn: conn.close())
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        # (соединение, время возврата), первым берется последнее возвращенное
+        self.idle = deque()
+        self.in_use = 0
+        self.waiting = 0
+        self.stats = {'acquired': 0, 'created': 0, 'discarded': 0, 'timeouts': 0, 'wait_seconds': 0.0}
+
+    def acquire(self):
+        """Возвращает (соединение, новое ли оно)"""
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            started = time.monotonic()
+            while not self.idle and self.in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout(f'нет свободного соединения за {self.timeout} с, размер пула {self.size}')
+                self.waiting += 1
+                try:
+                    self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.stats['wait_seconds'] += time.monotonic() - started
+            self.in_use += 1
+            self.stats['acquired'] += 1
+            entry = self.idle.pop() if self.idle else None
+
+        try:
+            if entry is not None:
+                conn, returned_at = entry
+                if self.is_healthy(conn, returned_at):
+                    return conn, False
+                self.discard(conn)
+            conn = self.connect()
+            with self.condition:
+                self.stats['created'] += 1
+            return conn, True
+        except BaseException:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+
+    def is_healthy(self, conn, returned_at):
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            self.ping(conn)
+            return True
+        except Exception:
+            return False
+
+    def release(self, conn, broken=False):
+        if not broken:
+            try:
+                # Незавершенная транзакция не должна достаться следующему потоку
+                self.reset(conn)
+            except Exception:
+                broken = True
+        with self.condition:
+            self.in_use -= 1
+            if broken:
+                self.stats['discarded'] += 1
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+        if broken:
+            self.discard(conn, counted=False)
+
+    def discard(self, conn, counted=True):
+        if counted:
+            with self.condition:
+                self.stats['discarded'] += 1
+        try:
+            self.close(conn)
+        except Exception:
+            pass
+
+    def snapshot(self):
+        with self.condition:
+            return dict(self.stats, size=self.size, in_use=self.in_use, idle=len(self.idle), waiting=self.waiting)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, factory):
+    """Пул алиаса в этом процессе; после fork дочерний процесс начинает с пустого"""
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[alias] = factory()
+        return pool
+
+
+def find_pool(alias):
+    with _pools_lock:
+        pool = _pools.get(alias)
+    return pool if pool is not None and pool.pid == os.getpid() else None
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.snapshot() for alias, pool in pools.items() if pool.pid == os.getpid()}
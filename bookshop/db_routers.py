@@ -0,0 +1,132 @@
+"""
+Реплики для чтения каталога с чтением своих записей.
+
+Модели каталога читаются со случайной реплики (алиасы DATABASES, начинающиеся
+с "replica"), все остальное и любая запись идут в "default". После коммита
+записи в модель каталога или корзины чтение остается на основной БД: до конца
+запроса или команды и еще REPLICA_PIN_SECONDS следующих запросов по cookie,
+так что посетитель не видит, как реплика отстает от его же изменений. Прочие
+записи (сессии, last_login) не закрепляют, иначе все вошедшие посетители
+читали бы с основной БД. Чтение внутри транзакции на основной БД всегда
+остается на ней, поэтому select_for_update() работает.
+
+После смены версии каталога (mainpage.cache.bump_catalogue_version) все
+посетители REPLICA_PIN_SECONDS читают каталог с основной БД: первый, кто
+заново заполняет кэш новой версии, не должен положить туда данные отстающей
+реплики. Защищает, только пока отставание реплик меньше REPLICA_PIN_SECONDS.
+"""
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+PIN_COOKIE = 'db_primary'
+CATALOGUE_MODELS = {
+    'mainpage.product', 'mainpage.category', 'mainpage.author', 'mainpage.rating',
+    'mainpage.ratingstar', 'mainpage.productratingsummary', 'mainpage.searchentry',
+}
+# Записи, после которых чтение закрепляется за основной БД
+PIN_MODELS = CATALOGUE_MODELS | {'mainpage.cart', 'mainpage.cartcontent'}
+# Время последнего изменения каталога, для всех процессов
+CATALOGUE_CHANGED_KEY = 'db:catalogue_changed_at'
+
+pinned = ContextVar('db_pinned', default=False)
+wrote = ContextVar('db_wrote', default=False)
+
+
+def get_replicas():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+
+def get_pin_seconds():
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+def pin_to_primary():
+    pinned.set(True)
+    wrote.set(True)
+
+
+def mark_catalogue_changed():
+    if get_replicas():
+        cache.set(CATALOGUE_CHANGED_KEY, time.time(), get_pin_seconds())
+
+
+def catalogue_changed_recently():
+    if not get_replicas():
+        return False
+    changed_at = cache.get(CATALOGUE_CHANGED_KEY)
+    # Копия ключа в L1 TieredCache может пережить его таймаут, поэтому сравнивается время
+    return changed_at is not None and time.time() - changed_at < get_pin_seconds()
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower not in CATALOGUE_MODELS or pinned.get():
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        replicas = get_replicas()
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Выбор БД - еще не запись: get_or_create() спрашивает алиас для записи заранее,
+        # а откаченная транзакция ничего не меняет, поэтому закрепляем после коммита
+        if model._meta.label_lower in PIN_MODELS:
+            transaction.on_commit(pin_to_primary, using=DEFAULT_DB_ALIAS)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики - копии default, объекты из любых из них могут быть связаны
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class PrimaryPinMiddleware:
+    """Чтение посетителя с основной БД REPLICA_PIN_SECONDS после его последней записи"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        tokens = self.start(request)
+        try:
+            response = self.get_response(request)
+            return self.finish(response)
+        finally:
+            self.reset(tokens)
+
+    async def __acall__(self, request):
+        tokens = self.start(request)
+        try:
+            response = await self.get_response(request)
+            return self.finish(response)
+        finally:
+            self.reset(tokens)
+
+    def start(self, request):
+        # Потоки воркера переиспользуют контекст между запросами, поэтому оба флага ставятся заново
+        pin = PIN_COOKIE in request.COOKIES or catalogue_changed_recently()
+        return pinned.set(pin), wrote.set(False)
+
+    def finish(self, response):
+        if wrote.get():
+            response.set_cookie(PIN_COOKIE, '1', max_age=get_pin_seconds(), httponly=True, samesite='Lax')
+        return response
+
+    def reset(self, tokens):
+        pinned.reset(tokens[0])
+        wrote.reset(tokens[1])
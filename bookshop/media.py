@@ -0,0 +1,130 @@
+"""
+Отдача MEDIA_ROOT: ETag, условные запросы, Range и сжатые копии (.br/.gz).
+
+Файлы с именем из хэша содержимого (bookshop.storage.ContentAddressedStorage)
+не меняются никогда и отдаются с Cache-Control: immutable на год.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags
+from django.views.decorators.http import require_safe
+
+from .storage import is_hashed_name
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = 'public, max-age=3600'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+CHUNK_SIZE = 64 * 1024
+
+
+# parse_range: диапазон корректен, но лежит за концом файла
+UNSATISFIABLE = object()
+
+
+def file_etag(name, stat, encoding=None):
+    if is_hashed_name(name):
+        tag = os.path.splitext(os.path.basename(name))[0]
+    else:
+        tag = '%x-%x' % (int(stat.st_mtime), stat.st_size)
+    # Сжатая копия - другие байты, поэтому и ETag у нее свой
+    return '"%s-%s"' % (tag, encoding) if encoding else '"%s"' % tag
+
+
+def parse_range(header, size):
+    """(start, end) включительно, UNSATISFIABLE или None, если заголовок не поддержан
+
+    Поддержан один диапазон; несколько диапазонов и ошибки в заголовке
+    игнорируются, и отдается весь файл.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        length = int(end)
+        return (max(size - length, 0), size - 1) if length and size else UNSATISFIABLE
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        return UNSATISFIABLE
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+def iter_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    stat = os.stat(full_path)
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (not if_range or if_range.strip() == file_etag(path, stat)):
+        byte_range = parse_range(range_header, stat.st_size)
+    encoding = None
+    if byte_range is None:
+        # Диапазоны отдаются только из несжатого файла
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        encoding = next((name for name, suffix in ENCODINGS
+                         if name in accept_encoding and os.path.isfile(full_path + suffix)), None)
+
+    etag = file_etag(path, stat, encoding)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if is_hashed_name(path) else DEFAULT_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+        'Vary': 'Accept-Encoding',
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        response = HttpResponseNotModified()
+        for key, value in headers.items():
+            response[key] = value
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    if byte_range is UNSATISFIABLE:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % stat.st_size
+        return response
+    if byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(iter_range(full_path, start, end - start + 1),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+        response['Content-Length'] = end - start + 1
+    elif encoding:
+        suffix = dict(ENCODINGS)[encoding]
+        response = FileResponse(open(full_path + suffix, 'rb'), content_type=content_type)
+        response['Content-Encoding'] = encoding
+    else:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    for key, value in headers.items():
+        response[key] = value
+    return response
@@ -49,10 +49,13 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'mainpage.middleware.MetricsMiddleware',
+    'bookshop.db_routers.PrimaryPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'mainpage.middleware.CartCookieMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -61,10 +64,16 @@ ROOT_URLCONF = 'bookshop.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, который учитывает время рендера в метриках запроса
+        'BACKEND': 'mainpage.metrics.TimedDjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Шаблоны компилируются один раз на процесс; в DEBUG кэш сбрасывает автоперезагрузка
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -72,6 +81,8 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'social_django.context_processors.backends',
                 'social_django.context_processors.login_redirect',
+                'mainpage.context_processors.catalogue',
+                'mainpage.context_processors.cart',
             ],
         },
     },
@@ -90,9 +101,42 @@ DATABASES = {
         'PASSWORD': '571183_abai',
         'HOST': '127.0.0.1',
         'PORT': '3306',
+        # Соединение живет DB_CONN_MAX_AGE секунд и проверяется перед повторным использованием
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# DB_POOL=1 - общий на процесс пул соединений (bookshop/db/mysql_pool), нужен под ASGI,
+# где у каждого запроса свой поток и постоянные соединения не переиспользуются
+if os.environ.get('DB_POOL') == '1':
+    DATABASES['default'].update({
+        'ENGINE': 'bookshop.db.mysql_pool',
+        # Соединение возвращается в пул в конце каждого запроса
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            'SIZE': int(os.environ.get('DB_POOL_SIZE', 10)),
+            # Сколько секунд ждать свободное соединение, потом OperationalError
+            'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+            # Соединение, простоявшее дольше, проверяется ping перед выдачей
+            'HEALTH_CHECK_INTERVAL': 30,
+        },
+    })
+
+# Реплики для чтения каталога: DB_REPLICAS="10.0.0.2:3306,10.0.0.3" добавляет
+# replica1, replica2 с теми же учетными данными, что у default
+DB_REPLICAS = [host.strip() for host in os.environ.get('DB_REPLICAS', '').split(',') if host.strip()]
+for number, replica in enumerate(DB_REPLICAS, 1):
+    replica_host, _, replica_port = replica.partition(':')
+    DATABASES[f'replica{number}'] = dict(DATABASES['default'], HOST=replica_host,
+                                         PORT=replica_port or DATABASES['default']['PORT'],
+                                         TEST={'MIRROR': 'default'})
+if DB_REPLICAS:
+    DATABASE_ROUTERS = ['bookshop.db_routers.ReplicaRouter']
+# Сколько секунд после записи посетитель (а после изменения каталога - все) читает
+# с основной БД; должно быть больше отставания реплик
+REPLICA_PIN_SECONDS = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 AUTHENTICATION_BACKENDS = (
@@ -141,14 +185,93 @@ STATICFILES_DIRS = []
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+# Загрузки сохраняются под хэшем содержимого и отдаются с immutable-кэшем
+DEFAULT_FILE_STORAGE = 'bookshop.storage.ContentAddressedStorage'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-CACHES = {
-    'default': {
+# Асинхронные виды каталога и корзины (mainpage/async_views.py), включаются в bookshop/asgi.py
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', '') == '1'
+
+# Общий кэш выбирается переменной SHARED_CACHE:
+# redis://... - Redis, db - таблица в БД (manage.py createcachetable), locmem - для тестов,
+# по умолчанию - файлы в bookshop_cache/. Лог инвалидаций TieredCache надежен только
+# с Redis (атомарный incr), с остальными копия в L1 может устареть на L1_TIMEOUT
+SHARED_CACHE = os.environ.get('SHARED_CACHE', '')
+
+if SHARED_CACHE.startswith(('redis://', 'rediss://')):
+    SHARED_CACHE_BACKEND = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': SHARED_CACHE,
+    }
+elif SHARED_CACHE == 'db':
+    SHARED_CACHE_BACKEND = {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'bookshop_cache',
+    }
+elif SHARED_CACHE == 'locmem':
+    SHARED_CACHE_BACKEND = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+else:
+    SHARED_CACHE_BACKEND = {
         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
         'LOCATION': os.path.join(BASE_DIR, 'bookshop_cache'),
     }
+
+CACHES = {
+    'default': {
+        'BACKEND': 'bookshop.cache.TieredCache',
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'L1_MAX_ENTRIES': 1000,
+            'L1_TIMEOUT': 5,
+            # Как часто процесс читает лог инвалидаций из общего кэша, секунд
+            'INVALIDATION_INTERVAL': 1,
+        },
+    },
+    'shared': SHARED_CACHE_BACKEND,
 }
+
+# Фрагменты каталога (карточки, категории) кэшируются с версией,
+# которая сбрасывается сигналами при изменении Product, Category и Author
+FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
+# Анонимные страницы каталога кэшируются целиком, CSRF-токен и cart_count
+# подставляются в готовый HTML при каждом ответе. Голоса кэш не сбрасывают,
+# рейтинги на страницах обновляются раз в PAGE_CACHE_TIMEOUT
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_TIMEOUT = 60
+# Анонимные страницы каталога отдаются с ETag (и Last-Modified у товара),
+# повторный запрос с актуальной копией получает 304 без рендера
+CONDITIONAL_GET_ENABLED = True
+
+# Запись оценок: sync - сразу в БД, buffered - в буфер в общем кэше (нужен Redis),
+# откуда их пачками пишет manage.py flush_ratings раз в RATING_FLUSH_INTERVAL секунд
+RATING_WRITE_MODE = os.environ.get('RATING_WRITE_MODE', 'sync')
+RATING_FLUSH_INTERVAL = 5
+
+# Фоновые задачи (mainpage/jobs.py): db - в таблицу Job, их выполняет manage.py run_jobs,
+# inline - сразу после коммита в том же процессе (разработка без воркера)
+JOB_RUNNER = os.environ.get('JOB_RUNNER', 'db')
+
+# Корзина анонимного посетителя: cookie - в подписанной cookie до входа,
+# session - запись Cart на каждую сессию
+CART_ANONYMOUS_MODE = 'cookie'
+# Корзины сессий, не менявшиеся дольше этого срока (секунд), и истекшие сессии
+# удаляет purge_carts (по cron или из фонового воркера)
+CART_ANONYMOUS_TTL = 60 * 60 * 24 * 14
+
+# Метрики запросов (mainpage/metrics.py): заголовок Server-Timing (разбивка по БД,
+# кэшу и шаблонам - при DEBUG, SERVER_TIMING_DETAILED и для персонала, остальным
+# только общее время), /metrics/ для Prometheus (доступен персоналу и адресам из
+# METRICS_ALLOWED_IPS) и лог
+# mainpage.slow_requests для доли SLOW_REQUEST_SAMPLE_RATE запросов дольше SLOW_REQUEST_MS
+SERVER_TIMING = True
+SERVER_TIMING_DETAILED = False
+METRICS_ALLOWED_IPS = ('127.0.0.1',)
+SLOW_REQUEST_MS = 500
+SLOW_REQUEST_SAMPLE_RATE = 0.1
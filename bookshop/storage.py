@@ -0,0 +1,68 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HASH_LENGTH = 32
+# Типы, для которых рядом с файлом кладутся сжатые копии .gz и, если установлен brotli, .br
+COMPRESSIBLE_TYPES = ('text/', 'image/svg+xml', 'application/json', 'application/javascript')
+COMPRESS_MIN_SIZE = 1024
+COMPRESSED_SUFFIXES = ('.br', '.gz')
+
+
+def is_hashed_name(name):
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return len(stem) == HASH_LENGTH and all(c in '0123456789abcdef' for c in stem)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Медиафайлы под именем из sha256 содержимого: product/3f/3fa9...e1.png.
+
+    Одинаковые загрузки превращаются в один файл, а имя меняется вместе с
+    содержимым, поэтому такие файлы можно отдавать с immutable-кэшем.
+    """
+
+    def hashed_name(self, name, content):
+        sha = hashlib.sha256()
+        for chunk in content.chunks():
+            sha.update(chunk)
+        digest = sha.hexdigest()[:HASH_LENGTH]
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        return os.path.join(directory, digest[:2], digest + extension)
+
+    def _save(self, name, content):
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            return name
+        name = super()._save(name, content)
+        self.save_compressed(name)
+        return name
+
+    def save_compressed(self, name):
+        content_type = mimetypes.guess_type(name)[0] or ''
+        size = self.size(name)
+        if not content_type.startswith(COMPRESSIBLE_TYPES) or size < COMPRESS_MIN_SIZE:
+            return
+        with self.open(name, 'rb') as f:
+            data = f.read()
+        compressed = {'.gz': gzip.compress(data, 9)}
+        if brotli is not None:
+            compressed['.br'] = brotli.compress(data, quality=11)
+        for suffix, content in compressed.items():
+            if len(content) < size:
+                super()._save(name + suffix, ContentFile(content))
+
+    def delete(self, name):
+        super().delete(name)
+        for suffix in COMPRESSED_SUFFIXES:
+            super().delete(name + suffix)
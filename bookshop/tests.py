@@ -0,0 +1,246 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from bookshop import cache as tiered
+from bookshop import db_routers, storage
+from bookshop.db.mysql_pool.pool import ConnectionPool, PoolTimeout
+from mainpage.models import Product
+
+PARAMS = {'OPTIONS': {'SHARED': 'shared', 'L1_TIMEOUT': 60, 'INVALIDATION_INTERVAL': 60}}
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-tests'},
+})
+class TieredCacheTests(SimpleTestCase):
+    def setUp(self):
+        tiered._processes.clear()
+        self.addCleanup(tiered._processes.clear)
+
+    def make_process(self):
+        """Кэш другого процесса: своя L1 и своя позиция в логе"""
+        tiered._processes.clear()
+        return tiered.TieredCache(None, PARAMS)
+
+    def test_threads_share_l1(self):
+        cache = tiered.TieredCache(None, PARAMS)
+        cache.set('key', 1)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(tiered.TieredCache(None, PARAMS).get('key')))
+        thread.start()
+        thread.join()
+        self.assertEqual(other, [1])
+        self.assertEqual(cache.stats['l1_hits'], 1)
+
+    def test_invalidation_between_processes(self):
+        first, second = self.make_process(), self.make_process()
+        first.set('key', 1)
+        self.assertEqual(second.get('key'), 1)
+        first.set('key', 2)
+        # До следующего чтения лога второй процесс отдает свою копию
+        self.assertEqual(second.get('key'), 1)
+        second.state.next_sync = 0
+        self.assertEqual(second.get('key'), 2)
+        first.delete('key')
+        second.state.next_sync = 0
+        self.assertIsNone(second.get('key'))
+
+    def test_get_many_one_shared_round_trip(self):
+        cache = tiered.TieredCache(None, PARAMS)
+        cache.set('a', 1)
+        cache.shared.set('b', 2)
+        with mock.patch.object(cache.shared, 'get_many', wraps=cache.shared.get_many) as shared_get_many:
+            self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        shared_get_many.assert_called_once_with(['b', 'c'], version=None)
+        self.assertEqual(cache.stats, {'l1_hits': 1, 'l2_hits': 1, 'misses': 1})
+        self.assertEqual(cache.get_many(['b']), {'b': 2})
+        self.assertEqual(cache.stats['l1_hits'], 2)
+
+    def test_forked_process_starts_empty(self):
+        cache = tiered.TieredCache(None, PARAMS)
+        cache.set('key', 1)
+        parent = cache.state
+        parent.pid = -1
+        self.assertIsNot(cache.state, parent)
+        self.assertNotEqual(cache.state.origin, parent.origin)
+        self.assertEqual(cache.get('key'), 1)
+        self.assertEqual(cache.stats, {'l1_hits': 0, 'l2_hits': 1, 'misses': 0})
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.rollbacks = 0
+
+    def ping(self):
+        if not self.alive:
+            raise OSError('gone away')
+
+    def rollback(self):
+        if not self.alive:
+            raise OSError('gone away')
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def make_pool(self, **kwargs):
+        self.connections = []
+
+        def connect():
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+        return ConnectionPool(connect, **kwargs)
+
+    def test_returned_connection_is_reused(self):
+        pool = self.make_pool(size=2)
+        conn, is_new = pool.acquire()
+        self.assertTrue(is_new)
+        pool.release(conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(pool.acquire(), (conn, False))
+        self.assertEqual(pool.snapshot()['in_use'], 1)
+        self.assertEqual((pool.stats['acquired'], pool.stats['created']), (2, 1))
+
+    def test_full_pool_times_out(self):
+        pool = self.make_pool(size=1, timeout=0.05)
+        pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        self.assertEqual(pool.stats['timeouts'], 1)
+
+    def test_waiter_gets_released_connection(self):
+        pool = self.make_pool(size=1, timeout=5)
+        conn, _ = pool.acquire()
+        timer = threading.Timer(0.05, pool.release, [conn])
+        timer.start()
+        self.assertEqual(pool.acquire(), (conn, False))
+        timer.join()
+
+    def test_dead_idle_connection_is_replaced(self):
+        pool = self.make_pool(size=1, health_check_interval=0)
+        conn, _ = pool.acquire()
+        pool.release(conn)
+        conn.alive = False
+        fresh, is_new = pool.acquire()
+        self.assertIsNot(fresh, conn)
+        self.assertTrue(is_new)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats['discarded'], 1)
+
+    def test_broken_connection_is_closed(self):
+        pool = self.make_pool(size=2)
+        first, _ = pool.acquire()
+        second, _ = pool.acquire()
+        pool.release(first, broken=True)
+        second.alive = False
+        pool.release(second)  # rollback не прошел
+        self.assertTrue(first.closed and second.closed)
+        self.assertEqual(pool.snapshot(), dict(pool.stats, size=2, in_use=0, idle=0, waiting=0))
+        self.assertEqual(pool.stats['discarded'], 2)
+
+    def test_failed_connect_frees_slot(self):
+        pool = ConnectionPool(lambda: 1 / 0, size=1, timeout=0.05)
+        with self.assertRaises(ZeroDivisionError):
+            pool.acquire()
+        self.assertEqual(pool.snapshot()['in_use'], 0)
+
+
+class ContentAddressedStorageTests(SimpleTestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.storage = storage.ContentAddressedStorage(location=location)
+
+    def test_compressed_copies_saved_and_deleted(self):
+        name = self.storage.save('docs/readme.txt', ContentFile(b'bookshop ' * 1000))
+        self.assertTrue(storage.is_hashed_name(name))
+        suffixes = ['.gz'] + (['.br'] if storage.brotli is not None else [])
+        for suffix in suffixes:
+            self.assertTrue(self.storage.exists(name + suffix))
+        self.storage.delete(name)
+        self.assertEqual(os.listdir(self.storage.path(os.path.dirname(name))), [])
+
+
+class MediaServeTests(SimpleTestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        override = override_settings(MEDIA_ROOT=location)
+        override.enable()
+        self.addCleanup(override.disable)
+        for name, content in (('book.txt', b'0123456789'), ('book.txt.gz', b'gzipped')):
+            with open(os.path.join(location, name), 'wb') as f:
+                f.write(content)
+
+    def get(self, **headers):
+        return self.client.get('/media/book.txt', headers=headers)
+
+    def test_ranges(self):
+        response = self.get(Range='bytes=2-4')
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (206, b'234'))
+        self.assertEqual(self.get(Range='bytes=20-').status_code, 416)
+        # Несколько диапазонов и ошибки в заголовке не поддержаны: весь файл
+        for header in ('bytes=0-1,4-5', 'bytes=5-2', 'items=0-1'):
+            response = self.get(Range=header)
+            self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, b'0123456789'))
+
+    def test_etag_depends_on_encoding(self):
+        plain, gzipped = self.get(), self.get(Accept_Encoding='gzip')
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertNotEqual(plain['ETag'], gzipped['ETag'])
+        self.assertEqual(self.get(If_None_Match=plain['ETag']).status_code, 304)
+        self.assertEqual(self.get(If_None_Match=plain['ETag'], Accept_Encoding='gzip').status_code, 200)
+
+
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.router = db_routers.ReplicaRouter()
+        tokens = db_routers.pinned.set(False), db_routers.wrote.set(False)
+        self.addCleanup(db_routers.pinned.reset, tokens[0])
+        self.addCleanup(db_routers.wrote.reset, tokens[1])
+
+    def test_pins_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.router.db_for_write(Product)
+            self.assertFalse(db_routers.pinned.get())
+        self.assertTrue(db_routers.pinned.get())
+        self.assertTrue(db_routers.wrote.get())
+
+    @mock.patch.object(db_routers, 'get_replicas', return_value=['replica1'])
+    def test_catalogue_change_pins_everyone(self, get_replicas):
+        request = RequestFactory().get('/')
+        middleware = db_routers.PrimaryPinMiddleware(lambda request: None)
+        cache.delete(db_routers.CATALOGUE_CHANGED_KEY)
+        tokens = middleware.start(request)
+        self.assertFalse(db_routers.pinned.get())
+        middleware.reset(tokens)
+        db_routers.mark_catalogue_changed()
+        tokens = middleware.start(request)
+        self.assertTrue(db_routers.pinned.get())
+        middleware.reset(tokens)
+
+    def test_rollback_and_other_models_do_not_pin(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.router.db_for_write(User)
+            try:
+                with transaction.atomic():
+                    self.router.db_for_write(Product)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertFalse(db_routers.pinned.get())
+        self.assertFalse(db_routers.wrote.get())
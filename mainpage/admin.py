@@ -1,18 +1,109 @@
+import csv
+
 from django.contrib import admin
+from django.contrib.admin.views.main import PAGE_VAR
+from django.core.paginator import Paginator
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.utils.functional import cached_property
 
+from . import jobs
 from .models import *
 
+# На сколько строк дальше текущей страницы считает COUNT(*) на отфильтрованном списке
+COUNT_LIMIT = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """Пагинатор без полного COUNT(*) на больших таблицах.
+
+    Для списка без фильтров берется оценка числа строк из статистики БД,
+    для отфильтрованного считается не больше COUNT_LIMIT строк после начала
+    страницы page_number: ссылки на страницы всегда ведут дальше, и до строк
+    за лимитом можно дойти.
+    """
+
+    def __init__(self, *args, page_number=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page_number = page_number
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if not query.where:
+            estimate = estimate_rows(self.object_list.model._meta.db_table)
+            if estimate is not None and estimate > COUNT_LIMIT:
+                return estimate
+        limit = (max(self.page_number, 1) - 1) * self.per_page + COUNT_LIMIT
+        return self.object_list.order_by()[:limit].count()
+
+
+def estimate_rows(table):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SELECT TABLE_ROWS FROM information_schema.TABLES '
+                           'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
+
+class Echo:
+    """Псевдо-файл для csv.writer: строка сразу отдается клиенту"""
+
+    def write(self, value):
+        return value
+
+
+@admin.action(description='Выгрузить выбранное в CSV')
+def export_csv(modeladmin, request, queryset):
+    fields = [name for name in modeladmin.get_list_display(request) if isinstance(name, str)]
+    queryset = queryset.order_by('pk')
+    if modeladmin.list_select_related:
+        queryset = queryset.select_related(*modeladmin.list_select_related)
+    writer = csv.writer(Echo())
+
+    def rows():
+        yield writer.writerow(fields)
+        for obj in queryset.iterator(chunk_size=2000):
+            yield writer.writerow([getattr(obj, name) for name in fields])
+
+    response = StreamingHttpResponse(rows(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{queryset.model._meta.model_name}.csv"'
+    return response
+
+
+class FastChangeListAdmin(admin.ModelAdmin):
+    """Список без полного COUNT(*), со связанными объектами одним JOIN и выгрузкой в CSV"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = [export_csv]
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        try:
+            page_number = int(request.GET.get(PAGE_VAR, 1))
+        except ValueError:
+            page_number = 1
+        return self.paginator(queryset, per_page, orphans, allow_empty_first_page, page_number=page_number)
+
 
 @admin.register(Author)
 class AuthorAdmin(admin.ModelAdmin):
     list_display = ['name', 'about', 'birth_day']
+    search_fields = ['name']
     prepopulated_fields = {'slug': ('name',)}
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(FastChangeListAdmin):
     list_display = ['title', 'author', 'img', 'is_sale']
-    search_fields = ['id', 'title']
+    list_select_related = ['author']
+    autocomplete_fields = ['author']
+    # '=id' - точное совпадение по первичному ключу, а не LIKE по id, приведенному к тексту
+    search_fields = ['=id', 'title']
     prepopulated_fields = {'slug': ('title',)}
 
 
@@ -33,14 +124,38 @@ class RatingStarAdmin(admin.ModelAdmin):
 
 
 @admin.register(Rating)
-class RatingAdmin(admin.ModelAdmin):
+class RatingAdmin(FastChangeListAdmin):
     list_display = ['id', 'star', 'product']
+    list_select_related = ['star', 'product']
+    autocomplete_fields = ['product']
+
+    def get_readonly_fields(self, request, obj=None):
+        # Сводка пересчитывается только для текущего товара оценки, перенос на другой товар ее сломал бы
+        if obj is not None:
+            return ['ip', 'product']
+        return []
 
 
 @admin.register(CartContent)
-class RatingAdmin(admin.ModelAdmin):
+class CartContentAdmin(FastChangeListAdmin):
     list_display = ['cart', 'product', 'qty']
+    list_select_related = ['cart', 'product']
+    raw_id_fields = ['cart']
+    autocomplete_fields = ['product']
 
 
 admin.site.site_title = 'Книжный магазин'
 admin.site.site_header = 'Книжный магазин'
+
+
+@admin.action(description='Повторить упавшие задачи')
+def retry_jobs(modeladmin, request, queryset):
+    modeladmin.message_user(request, f'Возвращено в очередь: {jobs.retry_failed(queryset)}')
+
+
+@admin.register(Job)
+class JobAdmin(FastChangeListAdmin):
+    list_display = ['id', 'name', 'status', 'attempts', 'run_at', 'locked_by', 'created_at']
+    list_filter = ['status', 'name']
+    readonly_fields = ['last_error']
+    actions = [retry_jobs, export_csv]
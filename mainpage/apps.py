@@ -6,3 +6,5 @@ class MainpageConfig(AppConfig):
     name = 'mainpage'
     verbose_name = 'Книжный магазин'
 
+    def ready(self):
+        from . import signals
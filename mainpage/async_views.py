@@ -0,0 +1,197 @@
+"""
+Асинхронные страницы каталога и корзины для запуска под ASGI (ASYNC_VIEWS = True).
+
+Async ORM в Django 4.2 выполняет все запросы одного HTTP-запроса по очереди
+в одном потоке, поэтому независимые запросы (строки страницы, популярное,
+счетчик, категории, содержимое корзины) запускаются через in_thread в
+отдельных потоках со своими соединениями и собираются asyncio.gather.
+Пока запросы выполняются, а медленный клиент читает ответ, воркер
+обслуживает другие соединения.
+"""
+import asyncio
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.http import Http404, HttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
+
+from . import views
+from .cache import (CART_COUNT_PLACEHOLDER, CSRF_TOKEN_PLACEHOLDER, fill_page_placeholders, get_not_modified,
+                    get_page_timeout, is_conditional, is_page_cacheable, make_page_etag, make_page_key,
+                    patch_page_validators)
+from .cart import CookieCart, get_or_create_cart, uses_cookie_cart
+from .forms import RatingForm
+from .models import CartContent, Category, Product
+from .utils import DataMixin, get_approximate_count, get_cached_categories, get_cursor, paginate_keyset
+
+PAGE_SIZE = DataMixin.paginate_by
+# Изменение корзины остается синхронным
+cart_update = views.CartView.as_view()
+
+
+def in_thread(func, *args):
+    """Корутина, выполняющая func(*args) в отдельном потоке со своим соединением к БД"""
+    def target():
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+    return sync_to_async(target, thread_sensitive=False)()
+
+
+async def is_authenticated(request):
+    # request.user ленивый и читает сессию и пользователя из БД, поэтому вычисляется в потоке
+    return await sync_to_async(lambda: request.user.is_authenticated)()
+
+
+async def render_page(request, template_name, context):
+    if getattr(request, 'page_cache_render', False):
+        context['csrf_token'] = CSRF_TOKEN_PLACEHOLDER
+        context['cart_count'] = CART_COUNT_PLACEHOLDER
+    content = await sync_to_async(render_to_string)(template_name, context, request)
+    return HttpResponse(content)
+
+
+def page_cache(view=None, *, last_modified=None):
+    """Кэш целой страницы и условный GET для анонимов, как PageCacheMixin у синхронных видов
+
+    last_modified(**kwargs) - время изменения содержимого страницы для Last-Modified.
+    """
+    if view is None:
+        return lambda view: page_cache(view, last_modified=last_modified)
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        await is_authenticated(request)
+        if not is_conditional(request):
+            return await get_page_response(view, request, *args, **kwargs)
+        etag = await sync_to_async(make_page_etag)(request)
+        modified = await in_thread(lambda: last_modified(**kwargs)) if last_modified else None
+        response = get_not_modified(request, etag, modified)
+        if response is None:
+            response = await get_page_response(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                patch_page_validators(response, etag, modified)
+        return response
+    return wrapper
+
+
+async def get_page_response(view, request, *args, **kwargs):
+    if not is_page_cacheable(request):
+        return await view(request, *args, **kwargs)
+
+    key = await sync_to_async(make_page_key)(request)
+    content = await cache.aget(key)
+    if content is not None:
+        response = HttpResponse(fill_page_placeholders(request, content))
+        response['X-Page-Cache'] = 'hit'
+    else:
+        request.page_cache_render = True
+        response = await view(request, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+        content = response.content.decode(response.charset)
+        await cache.aset(key, content, get_page_timeout())
+        response.content = fill_page_placeholders(request, content)
+        response['X-Page-Cache'] = 'miss'
+    patch_cache_control(response, private=True)
+    return response
+
+
+def list_context(page, **kwargs):
+    return dict(kwargs, paginator=None, page_obj=page, is_paginated=page.has_other_pages(),
+                object_list=page.object_list, product=page.object_list)
+
+
+def get_page(request, queryset):
+    return in_thread(paginate_keyset, queryset, PAGE_SIZE, get_cursor(request, 'after'),
+                     get_cursor(request, 'before'))
+
+
+@page_cache
+async def main_page(request):
+    queryset = Product.objects.catalogue()
+    page, popular = await asyncio.gather(
+        get_page(request, queryset),
+        in_thread(queryset.popular, PAGE_SIZE),
+    )
+    return await render_page(request, 'mainpage/mainpage.html',
+                             list_context(page, title='AB книжный магазин', popular=popular))
+
+
+@page_cache
+async def product_list(request):
+    queryset = Product.objects.catalogue()
+    page, count = await asyncio.gather(
+        get_page(request, queryset),
+        in_thread(get_approximate_count, queryset),
+    )
+    page.count = count
+    return await render_page(request, 'mainpage/products.html', list_context(page, title='Новинки'))
+
+
+@page_cache
+async def product_category(request, cat_slug):
+    # Фильтр по slug, а не по найденной категории, чтобы не ждать ее перед выборкой товаров
+    queryset = Product.objects.catalogue().filter(cat__slug=cat_slug)
+    category, page, count, cats = await asyncio.gather(
+        Category.objects.filter(slug=cat_slug).afirst(),
+        get_page(request, queryset),
+        in_thread(get_approximate_count, queryset),
+        in_thread(get_cached_categories),
+    )
+    page.count = count
+    if category is None or not count:
+        raise Http404
+    return await render_page(request, 'mainpage/products.html', list_context(
+        page, title='Категория - ' + category.title, cats=cats, cat_selected=category.pk))
+
+
+def product_last_modified(product_slug):
+    return Product.objects.last_modified(slug=product_slug)
+
+
+@page_cache(last_modified=product_last_modified)
+async def product_detail(request, product_slug):
+    try:
+        product = await Product.objects.with_relations().with_rating().aget(slug=product_slug)
+    except Product.DoesNotExist:
+        raise Http404
+    return await render_page(request, 'mainpage/product_detail.html', {
+        'object': product, 'product': product, 'title': product, 'star_form': RatingForm,
+    })
+
+
+async def get_cart(request):
+    """Корзина и ее позиции; корзина и позиции читаются одновременно"""
+    if uses_cookie_cart(request):
+        cart = CookieCart.from_request(request)
+        return cart, await in_thread(cart.get_cart_content)
+    if request.user.is_authenticated:
+        lookup = {'user_id': request.user.id}
+    else:
+        if not request.session.session_key:
+            await sync_to_async(request.session.save)()
+        lookup = {'session_key': request.session.session_key}
+    content = CartContent.objects.filter(**{'cart__' + field: value for field, value in lookup.items()})
+    cart, records = await asyncio.gather(
+        in_thread(lambda: get_or_create_cart(**lookup)),
+        in_thread(list, content.select_related('product')),
+    )
+    return cart, records
+
+
+async def cart_view(request):
+    if request.method != 'GET':
+        return await sync_to_async(cart_update)(request)
+    await is_authenticated(request)
+    cart, cart_records = await get_cart(request)
+    context = {
+        'cart_records': cart_records,
+        'cart_total': cart.get_total(),
+        'cart_count': cart.items_count,
+    }
+    return await render_page(request, 'mainpage/cart.html', context)
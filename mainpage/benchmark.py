@@ -0,0 +1,253 @@
+"""
+Нагрузочный прогон основных страниц магазина: команда benchmark.
+
+Каталог заполняется синтетическими данными (seed), затем сценарии
+(главная, списки, категория, карточка, поиск, корзина, рейтинг) гоняются
+через тестовый клиент Django или по HTTP через живой сервер. Для каждого
+сценария считаются перцентили времени ответа, число запросов к БД и
+выделенная память, для GET-страниц отдельно - время рендера шаблонов;
+результат сравнивается с сохраненным baseline.
+"""
+import math
+import random
+import re
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from . import search
+from .models import (Author, Cart, CartContent, Category, Product, ProductRatingSummary, Rating,
+                     RatingStar)
+
+SLUG_PREFIX = 'bench-'
+BENCH_IMAGE = 'product/bench.png'
+# Рост p95 меньше этого значения (мс) не считается регрессией: шум на быстрых запросах
+P95_SLACK_MS = 1.0
+
+Scenario = namedtuple('Scenario', 'name method path data user')
+TEMPLATE_TIMING = re.compile(r'\btpl;dur=([\d.]+)')
+
+
+def seed(products=2000, authors=200, categories=20, ratings=20000, carts=200, batch_size=1000, random_seed=0):
+    """Синтетический каталог; повторный вызов на заполненной БД ничего не делает"""
+    if Product.objects.filter(slug__startswith=SLUG_PREFIX).exists():
+        return False
+    rnd = random.Random(random_seed)
+    stars = [RatingStar.objects.get_or_create(value=value)[0] for value in range(1, 6)]
+
+    Category.objects.bulk_create([
+        Category(title=f'Категория {i}', slug=f'{SLUG_PREFIX}cat-{i}', description='Описание категории')
+        for i in range(categories)
+    ], batch_size=batch_size)
+    Author.objects.bulk_create([
+        Author(name=f'Автор {i}', slug=f'{SLUG_PREFIX}author-{i}', about='Об авторе')
+        for i in range(authors)
+    ], batch_size=batch_size)
+    category_ids = list(Category.objects.filter(slug__startswith=SLUG_PREFIX).values_list('pk', flat=True))
+    author_ids = list(Author.objects.filter(slug__startswith=SLUG_PREFIX).values_list('pk', flat=True))
+
+    variants = {'source': BENCH_IMAGE, 'width': 600, 'height': 900, 'formats': {
+        fmt: [{'name': f'product/variants/bench-{w}w.{ext}', 'width': w, 'height': w * 3 // 2}
+              for w in (160, 320, 480)]
+        for fmt, ext in (('webp', 'webp'), ('jpeg', 'jpg'))
+    }}
+    Product.objects.bulk_create([
+        Product(title=f'Книга {i} {rnd.choice(("о войне", "о мире", "о любви", "о море"))}',
+                slug=f'{SLUG_PREFIX}book-{i}', description='Описание книги ' * 20,
+                price=Decimal(rnd.randint(100, 3000)), author_id=rnd.choice(author_ids),
+                img=BENCH_IMAGE, img_variants=variants)
+        for i in range(products)
+    ], batch_size=batch_size)
+    product_ids = list(Product.objects.filter(slug__startswith=SLUG_PREFIX).values_list('pk', flat=True))
+
+    Through = Product.cat.through
+    Through.objects.bulk_create([
+        Through(product_id=product_id, category_id=category_id)
+        for product_id in product_ids for category_id in rnd.sample(category_ids, min(2, len(category_ids)))
+    ], batch_size=batch_size)
+
+    # Пары (ip, товар) не повторяются, как у настоящих голосов
+    Rating.objects.bulk_create([
+        Rating(ip=f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}', product_id=product_ids[i % len(product_ids)],
+               star=rnd.choice(stars))
+        for i in range(ratings)
+    ], batch_size=batch_size)
+    ProductRatingSummary.rebuild(product_ids)
+
+    for i in range(carts):
+        user = User.objects.create_user(f'{SLUG_PREFIX}user-{i}', password=None)
+        cart = Cart.objects.create(user=user)
+        CartContent.objects.bulk_create([
+            CartContent(cart=cart, product_id=product_id, qty=rnd.randint(1, 3))
+            for product_id in rnd.sample(product_ids, min(rnd.randint(1, 5), len(product_ids)))
+        ])
+        cart.recalculate()
+
+    search.index_products(search.indexable_products().filter(pk__in=product_ids), batch_size=batch_size)
+    return True
+
+
+def get_scenarios():
+    products = Product.objects.filter(slug__startswith=SLUG_PREFIX).order_by('-pk')
+    product = products.first()
+    middle = products.values_list('pk', flat=True)[products.count() // 2]
+    category = Category.objects.filter(slug__startswith=SLUG_PREFIX).first()
+    star = RatingStar.objects.order_by('-value').first()
+    return [
+        Scenario('home', 'get', '/', None, False),
+        Scenario('home:user', 'get', '/', None, True),
+        Scenario('products', 'get', '/products', None, False),
+        Scenario('products:user', 'get', '/products', None, True),
+        Scenario('products:deep:user', 'get', f'/products?after={middle}', None, True),
+        Scenario('category:user', 'get', category.get_absolute_url(), None, True),
+        Scenario('detail', 'get', product.get_absolute_url(), None, False),
+        Scenario('detail:user', 'get', product.get_absolute_url(), None, True),
+        Scenario('search:user', 'get', '/search/?q=книга+о+вой', None, True),
+        # Самый короткий префикс - самый широкий разворот последнего слова
+        Scenario('suggest', 'get', '/search/suggest/?q=во', None, False),
+        Scenario('cart-add:user', 'post', '/cart/', {'p_id': product.pk, 'qty': 2}, True),
+        Scenario('cart:user', 'get', '/cart/', None, True),
+        Scenario('rating', 'post', '/add-rating/', {'star': star.pk, 'product': product.pk}, False),
+    ]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summarize(timings, queries=None, allocated=None):
+    result = {
+        'n': len(timings),
+        'p50': round(percentile(timings, 50), 3),
+        'p95': round(percentile(timings, 95), 3),
+        'p99': round(percentile(timings, 99), 3),
+        'max': round(max(timings), 3),
+    }
+    if queries is not None:
+        result['queries'] = max(queries)
+    if allocated is not None:
+        result['alloc_kb'] = round(allocated / 1024, 1)
+    return result
+
+
+def make_clients():
+    anonymous = Client()
+    user = Client()
+    user.force_login(User.objects.filter(username__startswith=SLUG_PREFIX).first())
+    return {False: anonymous, True: user}
+
+
+def send(client, scenario):
+    if scenario.method == 'post':
+        response = client.post(scenario.path, scenario.data)
+    else:
+        response = client.get(scenario.path)
+    if response.status_code >= 400:
+        raise AssertionError(f'{scenario.name}: {scenario.path} -> {response.status_code}')
+    return response
+
+
+def run_client(scenarios, iterations=50, warmup=3):
+    """Прогон через тестовый клиент: время, запросы к БД и память на запрос"""
+    clients = make_clients()
+    results = {}
+    for scenario in scenarios:
+        client = clients[scenario.user]
+        for _ in range(warmup):
+            send(client, scenario)
+        timings, queries = [], []
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                send(client, scenario)
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+        # Память меряется отдельным запросом: tracemalloc сильно замедляет код
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        send(client, scenario)
+        allocated = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        results[scenario.name] = summarize(timings, queries, allocated)
+    return results
+
+
+def run_templates(scenarios, iterations=50, warmup=3):
+    """Время рендера шаблонов GET-страниц без кэша страниц: tpl из Server-Timing (mainpage/metrics.py)"""
+    clients = make_clients()
+    results = {}
+    # Анонимам и не персоналу без DEBUG Server-Timing отдает только total
+    with override_settings(PAGE_CACHE_ENABLED=False, SERVER_TIMING=True, SERVER_TIMING_DETAILED=True):
+        for scenario in scenarios:
+            if scenario.method != 'get':
+                continue
+            client = clients[scenario.user]
+            for _ in range(warmup):
+                send(client, scenario)
+            timings = []
+            for _ in range(iterations):
+                response = send(client, scenario)
+                match = TEMPLATE_TIMING.search(response.get('Server-Timing', ''))
+                # JSON-ответы (подсказки поиска) шаблонов не рендерят
+                if match is None or not response.get('Content-Type', '').startswith('text/html'):
+                    break
+                timings.append(float(match.group(1)))
+            if timings:
+                results[f'tpl:{scenario.name}'] = summarize(timings)
+    return results
+
+
+def run_live(base_url, scenarios, iterations=50, concurrency=4):
+    """Прогон GET-сценариев анонима по HTTP в несколько потоков"""
+    results = {}
+
+    def fetch(url):
+        start = time.perf_counter()
+        with urllib.request.urlopen(url) as response:
+            response.read()
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for scenario in scenarios:
+            if scenario.method != 'get' or scenario.user:
+                continue
+            # Кириллица в пути (подсказки поиска) должна уйти в запрос в %-кодировке
+            url = base_url + urllib.parse.quote(scenario.path, safe='/?=&+')
+            fetch(url)
+            timings = list(pool.map(fetch, [url] * iterations * concurrency))
+            results[f'live:{scenario.name}'] = summarize(timings)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2, only=None):
+    """Регрессии относительно baseline: больше запросов к БД или p95 вырос больше чем на tolerance
+
+    Сценарий из baseline, которого нет в результатах, - тоже проблема, иначе
+    пропавшие замеры (например, tpl:*) молча перестают проверяться. only -
+    имена сценариев прогона с --only, остальные не ожидаются.
+    """
+    problems = []
+    for name, base in baseline.get('scenarios', {}).items():
+        scenario = name.split(':', 1)[1] if name.startswith(('tpl:', 'live:')) else name
+        if only is not None and scenario not in only:
+            continue
+        current = results.get(name)
+        if current is None:
+            problems.append(f'{name}: есть в baseline, но не измерен')
+            continue
+        if 'queries' in base and current.get('queries', 0) > base['queries']:
+            problems.append(f'{name}: запросов к БД {current["queries"]} вместо {base["queries"]}')
+        limit = base['p95'] * (1 + tolerance) + P95_SLACK_MS
+        if current['p95'] > limit:
+            problems.append(f'{name}: p95 {current["p95"]:.1f} мс, допустимо до {limit:.1f} мс')
+    return problems
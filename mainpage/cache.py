@@ -0,0 +1,129 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from bookshop.db_routers import mark_catalogue_changed
+
+CATALOGUE_VERSION_KEY = 'catalogue:version'
+
+
+def get_fragment_timeout():
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60 * 60)
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Если ключ вытеснен, новая версия все равно больше всех прежних
+        version = int(time.time() * 1000)
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return get_version(key)
+
+
+def get_catalogue_version():
+    return get_version(CATALOGUE_VERSION_KEY)
+
+
+def bump_catalogue_version():
+    # Кэш новой версии заполняется с основной БД, а не с отстающей реплики
+    mark_catalogue_changed()
+    return bump_version(CATALOGUE_VERSION_KEY)
+
+
+def make_key(name, *parts, version=None):
+    version = get_catalogue_version() if version is None else version
+    return ':'.join(['catalogue', str(version), name] + [str(part) for part in parts])
+
+
+def cached(name, *parts, producer, timeout=None):
+    """Значение из кэша под ключом текущей версии каталога, иначе producer()"""
+    key = make_key(name, *parts)
+    value = cache.get(key)
+    if value is None:
+        value = producer()
+        cache.set(key, value, get_fragment_timeout() if timeout is None else timeout)
+    return value
+
+
+# Плейсхолдеры для персональных данных в закэшированной странице,
+# подставляются для каждого запроса после чтения из кэша
+CSRF_TOKEN_PLACEHOLDER = '__bookshop_csrf_token__'
+CART_COUNT_PLACEHOLDER = '__bookshop_cart_count__'
+
+
+def get_page_timeout():
+    return getattr(settings, 'PAGE_CACHE_TIMEOUT', 60)
+
+
+def is_page_cacheable(request):
+    return (getattr(settings, 'PAGE_CACHE_ENABLED', True)
+            and request.method in ('GET', 'HEAD')
+            and not request.user.is_authenticated)
+
+
+def make_page_key(request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    # Голос не сбрасывает кэш страниц: иначе на популярном сайте каждая оценка
+    # обнуляет его целиком. Рейтинги на странице отстают не больше чем на PAGE_CACHE_TIMEOUT
+    return make_key('page', path)
+
+
+def get_cart_count(request):
+    count = request.COOKIES.get('cart_count', '')
+    # isdecimal, а не isdigit: int() не разбирает надстрочные цифры вроде "²"
+    return int(count) if count.isdecimal() else 0
+
+
+def fill_page_placeholders(request, content):
+    return (content.replace(CSRF_TOKEN_PLACEHOLDER, get_token(request))
+            .replace(CART_COUNT_PLACEHOLDER, str(get_cart_count(request))))
+
+
+# Условный GET для анонимов: ETag строится из версии каталога и номера окна
+# PAGE_CACHE_TIMEOUT без запросов к БД, Last-Modified - из updated_at, если вид
+# его знает. Окно ограничивает устаревание рейтингов тем же сроком, что и у кэша
+# страниц. Страница содержит CSRF-токен и cart_count, поэтому в ETag входят и их cookie.
+
+def is_conditional(request):
+    return (getattr(settings, 'CONDITIONAL_GET_ENABLED', True)
+            and request.method in ('GET', 'HEAD')
+            and not request.user.is_authenticated)
+
+
+def make_page_etag(request):
+    window = int(time.time() // max(get_page_timeout(), 1))
+    parts = [get_catalogue_version(), window, request.get_full_path(),
+             request.COOKIES.get('cart_count', ''), request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')]
+    return '"%s"' % hashlib.md5(':'.join(map(str, parts)).encode()).hexdigest()
+
+
+def patch_page_validators(response, etag, last_modified=None):
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified.timestamp())
+    # Копия в браузере проверяется при каждом открытии, общие кэши ее не хранят
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def get_not_modified(request, etag, last_modified=None):
+    """304 без рендера, если копия клиента актуальна, иначе None"""
+    timestamp = int(last_modified.timestamp()) if last_modified is not None else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        patch_page_validators(response, etag, last_modified)
+    return response
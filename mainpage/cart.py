@@ -0,0 +1,240 @@
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Exists, F, IntegerField, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Cart, CartContent, Product
+
+CART_COOKIE = 'cart'
+CART_COOKIE_SALT = 'mainpage.cart'
+CART_COOKIE_MAX_AGE = 60 * 60 * 24 * 30
+# Ограничение позиций, чтобы cookie не превысила 4 КБ
+CART_COOKIE_MAX_ITEMS = 50
+
+
+class CartFull(Exception):
+    """В корзине-cookie уже CART_COOKIE_MAX_ITEMS позиций"""
+
+
+def uses_cookie_cart(request):
+    return (not request.user.is_authenticated
+            and getattr(settings, 'CART_ANONYMOUS_MODE', 'cookie') == 'cookie')
+
+
+class CookieCartItem:
+    def __init__(self, product, qty):
+        self.product = product
+        self.qty = qty
+
+
+class CookieCart:
+    """Корзина анонимного посетителя в подписанной cookie, без записей в БД"""
+
+    def __init__(self, items=None):
+        # {id товара: кол-во}
+        self.items = {int(pk): int(qty) for pk, qty in (items or {}).items() if int(qty) > 0}
+        self._content = None
+
+    @classmethod
+    def from_request(cls, request):
+        raw = request.get_signed_cookie(CART_COOKIE, default=None, salt=CART_COOKIE_SALT,
+                                        max_age=CART_COOKIE_MAX_AGE)
+        try:
+            return cls(json.loads(raw) if raw else None)
+        except (TypeError, ValueError, AttributeError):
+            return cls()
+
+    def save(self, response):
+        if self.items:
+            response.set_signed_cookie(CART_COOKIE, json.dumps(self.items), salt=CART_COOKIE_SALT,
+                                       max_age=CART_COOKIE_MAX_AGE, httponly=True, samesite='Lax')
+        else:
+            response.delete_cookie(CART_COOKIE)
+        return response
+
+    @property
+    def items_count(self):
+        return len(self.items)
+
+    def set_qty(self, product_id, qty):
+        if qty <= 0:
+            self.items.pop(product_id, None)
+        elif product_id in self.items or len(self.items) < CART_COOKIE_MAX_ITEMS:
+            self.items[product_id] = qty
+        else:
+            raise CartFull(product_id)
+        self._content = None
+
+    def clear(self):
+        self.items = {}
+        self._content = None
+
+    def get_cart_content(self):
+        if self._content is None:
+            order = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(self.items)])
+            products = Product.objects.filter(pk__in=self.items).order_by(order) if self.items else []
+            self._content = [CookieCartItem(product, self.items[product.pk]) for product in products]
+        return self._content
+
+    def get_total(self):
+        return sum((item.product.price * item.qty for item in self.get_cart_content()), 0)
+
+
+# Операции с корзиной. Каждая выполняется в одной транзакции и начинается с
+# UPDATE строки Cart: сдвиг суммы и кол-ва позиций считается в БД по цене и
+# прежнему кол-ву товара, а блокировка строки Cart выстраивает в очередь
+# операции над одной корзиной, поэтому INSERT позиции не гонится с соседним
+# и обходится без SAVEPOINT. Вторым запросом меняется сама позиция.
+
+def get_or_create_cart(**lookup):
+    # get_or_create роутер считает записью даже для существующей корзины,
+    # поэтому сначала обычный SELECT, а создание - только если корзины нет
+    try:
+        return Cart.objects.get(**lookup)
+    except Cart.DoesNotExist:
+        cart, _ = Cart.objects.get_or_create(**lookup)
+        return cart
+
+
+def get_user_cart(user_id):
+    return get_or_create_cart(user_id=user_id)
+
+
+def get_session_cart(session_key):
+    return get_or_create_cart(session_key=session_key)
+
+
+def _price(product_id):
+    # Если товара нет, INSERT позиции упадет на внешнем ключе (в SQLite - при коммите)
+    return Coalesce(Subquery(Product.objects.filter(pk=product_id).values('price')[:1]), Value(0))
+
+
+def _content(cart, product_id):
+    return CartContent.objects.filter(cart_id=cart.pk, product_id=product_id)
+
+
+def _old_qty(cart, product_id):
+    return Coalesce(Subquery(_content(cart, product_id).values('qty')[:1]), Value(0),
+                    output_field=IntegerField())
+
+
+def _in_cart(cart, product_id):
+    return Case(When(Exists(_content(cart, product_id)), then=Value(1)), default=Value(0))
+
+
+def _shift(cart, **changes):
+    """UPDATE агрегатов корзины; сумму посчитала БД, она перечитается при первом обращении"""
+    now = timezone.now()
+    Cart.objects.filter(pk=cart.pk).update(updated_at=now, **changes)
+    cart.updated_at = now
+    cart.__dict__.pop('total_cost', None)
+
+
+def _insert_content(cart, product_id, qty):
+    content = CartContent(cart=cart, product_id=product_id, qty=qty)
+    if connection.features.supports_update_conflicts:
+        unique_fields = ['cart', 'product'] if connection.features.supports_update_conflicts_with_target else None
+        CartContent.objects.bulk_create([content], update_conflicts=True,
+                                        unique_fields=unique_fields, update_fields=['qty'])
+    else:
+        content.save(force_insert=True)
+
+
+def add(cart, product_id, qty=1):
+    """Увеличивает кол-во товара в корзине на qty"""
+    if isinstance(cart, CookieCart):
+        return cart.set_qty(product_id, cart.items.get(product_id, 0) + qty)
+    with transaction.atomic():
+        _shift(cart, total_cost=F('total_cost') + _price(product_id) * qty,
+               items_count=F('items_count') + 1 - _in_cart(cart, product_id))
+        if not _content(cart, product_id).update(qty=F('qty') + qty):
+            _insert_content(cart, product_id, qty)
+            cart.items_count += 1
+
+
+def set_qty(cart, product_id, qty):
+    """Устанавливает кол-во товара, qty <= 0 убирает его из корзины"""
+    if isinstance(cart, CookieCart):
+        return cart.set_qty(product_id, qty)
+    if qty <= 0:
+        return remove(cart, product_id)
+    with transaction.atomic():
+        _shift(cart, total_cost=F('total_cost') + _price(product_id) * (qty - _old_qty(cart, product_id)),
+               items_count=F('items_count') + 1 - _in_cart(cart, product_id))
+        if not _content(cart, product_id).update(qty=qty):
+            _insert_content(cart, product_id, qty)
+            cart.items_count += 1
+
+
+def set_many(cart, items):
+    """Записывает {id товара: кол-во} одним INSERT ... ON DUPLICATE KEY UPDATE"""
+    if isinstance(cart, CookieCart):
+        for product_id, qty in items.items():
+            cart.set_qty(product_id, qty)
+        return
+    contents = [CartContent(cart=cart, product_id=product_id, qty=qty)
+                for product_id, qty in items.items() if qty > 0]
+    unique_fields = None
+    if connection.features.supports_update_conflicts_with_target:
+        unique_fields = ['cart', 'product']
+    with transaction.atomic():
+        CartContent.objects.bulk_create(contents, update_conflicts=True,
+                                        unique_fields=unique_fields, update_fields=['qty'])
+        cart.recalculate()
+        cart.refresh_from_db(fields=['total_cost', 'items_count'])
+
+
+def remove(cart, product_id):
+    if isinstance(cart, CookieCart):
+        return cart.set_qty(product_id, 0)
+    with transaction.atomic():
+        _shift(cart, total_cost=F('total_cost') - _price(product_id) * _old_qty(cart, product_id),
+               items_count=F('items_count') - _in_cart(cart, product_id))
+        cart.items_count -= _content(cart, product_id).delete()[0]
+
+
+def clear(cart):
+    if isinstance(cart, CookieCart):
+        return cart.clear()
+    with transaction.atomic():
+        CartContent.objects.filter(cart=cart).delete()
+        Cart.objects.filter(pk=cart.pk).update(total_cost=0, items_count=0, updated_at=timezone.now())
+    cart.total_cost = 0
+    cart.items_count = 0
+
+
+def forget(request):
+    """При выходе: корзина пользователя очищается, корзина его сессии удаляется"""
+    if request.user.is_authenticated:
+        cart = Cart.objects.filter(user_id=request.user.id).first()
+        if cart is not None:
+            clear(cart)
+    session_key = request.session.session_key
+    if session_key:
+        Cart.objects.filter(session_key=session_key, user=None).delete()
+
+
+def expired_anonymous_carts(ttl=None):
+    """Корзины сессий, не менявшиеся дольше CART_ANONYMOUS_TTL секунд"""
+    if ttl is None:
+        ttl = getattr(settings, 'CART_ANONYMOUS_TTL', settings.SESSION_COOKIE_AGE)
+    return Cart.objects.filter(user=None, updated_at__lt=timezone.now() - timedelta(seconds=ttl))
+
+
+def merge_cookie_cart(request, user):
+    """Переносит корзину из cookie в Cart пользователя после входа"""
+    cookie_cart = CookieCart.from_request(request)
+    if not cookie_cart.items:
+        return None
+    cart = get_user_cart(user.pk)
+    existing = Product.objects.filter(pk__in=cookie_cart.items).values_list('pk', flat=True)
+    with transaction.atomic():
+        # Кол-во из cookie добавляется к тому, что уже лежит в корзине пользователя
+        current = dict(CartContent.objects.select_for_update()
+                       .filter(cart=cart, product_id__in=cookie_cart.items).values_list('product_id', 'qty'))
+        set_many(cart, {pk: (current.get(pk) or 0) + cookie_cart.items[pk] for pk in existing})
+    return cart
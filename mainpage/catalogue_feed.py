@@ -0,0 +1,271 @@
+"""
+Потоковый импорт и экспорт каталога в CSV и JSONL.
+
+Каждая запись фида - категория, автор или товар (поле kind, по умолчанию
+product); связи задаются slug'ами:
+
+    {"kind": "category", "slug": "roman", "title": "Роман", "description": ""}
+    {"kind": "author", "slug": "tolstoy", "name": "Лев Толстой", "about": "", "birth_day": "1828-09-09"}
+    {"kind": "product", "slug": "war", "title": "Война и мир", "description": "", "price": "990.00",
+     "is_sale": true, "img": "product/war.png", "author": "tolstoy", "categories": ["roman"]}
+
+В CSV те же поля в колонках FIELDS, категории товара перечисляются через "|".
+Записи пишутся пачками через bulk_create(update_conflicts=True) по slug,
+так что повторный импорт обновляет существующие строки. Автор и категории
+товара должны быть в БД или встретиться в фиде раньше самого товара.
+"""
+import csv
+import json
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Prefetch
+
+from . import search
+from .cache import bump_catalogue_version
+from .models import Author, Category, Product
+
+FIELDS = ('kind', 'slug', 'title', 'name', 'description', 'about', 'birth_day',
+          'price', 'is_sale', 'img', 'author', 'categories')
+CATEGORY_SEPARATOR = '|'
+
+# Поля, которые обновляются у уже существующих строк
+# updated_at заполняется bulk_create, но при конфликте обновляется, только если указан здесь
+UPDATE_FIELDS = {
+    Category: ['title', 'description', 'updated_at'],
+    Author: ['name', 'about', 'birth_day', 'updated_at'],
+    Product: ['title', 'description', 'price', 'is_sale', 'author', 'updated_at'],
+}
+# Поля, которые не проверяются clean_fields: необязательные в фиде и связи по slug
+UNCHECKED_FIELDS = {
+    Category: ['description'],
+    Author: ['about'],
+    Product: ['description', 'img', 'author'],
+}
+
+
+class FeedError(ValueError):
+    pass
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def read_records(stream, fmt):
+    """(номер строки, запись) по одной, без чтения файла целиком
+
+    Строка JSONL отдается как есть и разбирается в CatalogueImporter.add,
+    чтобы испорченная строка стала ошибкой записи, а не остановила импорт.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            record.pop(None, None)  # значения из лишних колонок
+            yield reader.line_num, record
+    else:
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                yield number, line
+
+
+def parse_record(record):
+    if isinstance(record, (str, bytes)):
+        record = json.loads(record)
+    if not isinstance(record, dict):
+        raise FeedError(f'запись должна быть объектом, а не {type(record).__name__}')
+    return record
+
+
+def get_text(record, field, default=''):
+    value = record.get(field)
+    return default if value is None or value == '' else str(value).strip()
+
+
+def parse_bool(value, default=True):
+    if isinstance(value, bool):
+        return value
+    if value is None or value == '':
+        return default
+    return str(value).strip().lower() not in ('', '0', 'false', 'no', 'нет')
+
+
+def parse_price(value):
+    try:
+        price = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise FeedError(f'неверная цена {value!r}')
+    # NaN и бесконечность не сравниваются с нулем, а в bulk_create роняют всю пачку
+    if not price.is_finite() or price < 0:
+        raise FeedError(f'неверная цена {value!r}')
+    return price
+
+
+def check_fields(obj):
+    """Проверки модели (slug, max_length, разрядность цены) до записи, а не ошибкой БД посреди пачки"""
+    try:
+        obj.clean_fields(exclude=UNCHECKED_FIELDS[type(obj)])
+    except ValidationError as e:
+        raise FeedError('; '.join(f'{field}: {" ".join(messages)}' for field, messages in e.message_dict.items()))
+    return obj
+
+
+def parse_categories(value):
+    if isinstance(value, list):
+        return [str(slug) for slug in value]
+    return [slug.strip() for slug in str(value or '').split(CATEGORY_SEPARATOR) if slug.strip()]
+
+
+def upsert(model, objects, update_fields):
+    """INSERT ... ON CONFLICT/ON DUPLICATE KEY UPDATE по slug"""
+    if not objects:
+        return
+    # Повтор slug в одном INSERT ... ON CONFLICT недопустим, побеждает последняя запись
+    objects = list({obj.slug: obj for obj in objects}.values())
+    unique_fields = None
+    if connection.features.supports_update_conflicts_with_target:
+        unique_fields = ['slug']
+    model.objects.bulk_create(objects, update_conflicts=True, unique_fields=unique_fields,
+                              update_fields=update_fields)
+
+
+class CatalogueImporter:
+    """Накапливает записи фида и пишет их пачками по batch_size"""
+
+    def __init__(self, batch_size=1000, reindex=True):
+        self.batch_size = batch_size
+        self.reindex = reindex
+        # slug -> id; заполняется из БД один раз и дополняется после каждой пачки
+        self.authors = dict(Author.objects.values_list('slug', 'id'))
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        self.pending = {Category: [], Author: [], Product: []}
+        self.counts = {Category: 0, Author: 0, Product: 0}
+        self.errors = []
+
+    def add(self, record, line=None):
+        try:
+            record = parse_record(record)
+            kind = get_text(record, 'kind', 'product')
+            slug = get_text(record, 'slug')
+            if not slug:
+                raise FeedError('нет slug')
+            if kind == 'category':
+                self.pending[Category].append(check_fields(Category(
+                    slug=slug, title=record['title'], description=record.get('description') or '')))
+            elif kind == 'author':
+                birth_day = record.get('birth_day') or None
+                self.pending[Author].append(check_fields(Author(
+                    slug=slug, name=record['name'], about=record.get('about') or '',
+                    birth_day=date.fromisoformat(birth_day) if birth_day else None)))
+            elif kind == 'product':
+                self.pending[Product].append((check_fields(Product(
+                    slug=slug, title=record['title'], description=record.get('description') or '',
+                    price=parse_price(record['price']), is_sale=parse_bool(record.get('is_sale')),
+                    img=record.get('img') or '',
+                )), str(record['author']).strip(), parse_categories(record.get('categories'))))
+            else:
+                raise FeedError(f'неизвестный kind {kind!r}')
+        except (KeyError, ValueError, TypeError) as e:
+            self.errors.append((line, f'{type(e).__name__}: {e}'))
+            return
+        if len(self.pending[Product]) >= self.batch_size:
+            self.flush()
+        elif max(len(self.pending[Category]), len(self.pending[Author])) >= self.batch_size:
+            self.flush_references()
+
+    def flush_references(self):
+        for model, mapping in ((Category, self.categories), (Author, self.authors)):
+            objects, self.pending[model] = self.pending[model], []
+            if not objects:
+                continue
+            with transaction.atomic():
+                upsert(model, objects, UPDATE_FIELDS[model])
+            slugs = [obj.slug for obj in objects]
+            mapping.update(model.objects.filter(slug__in=slugs).values_list('slug', 'id'))
+            self.counts[model] += len(objects)
+
+    def flush(self):
+        # Авторы и категории из той же пачки фида должны попасть в БД раньше товаров
+        self.flush_references()
+        rows, self.pending[Product] = self.pending[Product], []
+        products, links = [], {}
+        for product, author_slug, category_slugs in rows:
+            if author_slug not in self.authors:
+                self.errors.append((product.slug, f'неизвестный автор {author_slug!r}'))
+                continue
+            missing = [slug for slug in category_slugs if slug not in self.categories]
+            if missing:
+                self.errors.append((product.slug, f'неизвестные категории {missing}'))
+                continue
+            product.author_id = self.authors[author_slug]
+            products.append(product)
+            links[product.slug] = [self.categories[slug] for slug in category_slugs]
+        if not products:
+            return
+
+        with transaction.atomic():
+            # Картинку обновляем только у строк, где она указана, иначе затрем загруженную
+            upsert(Product, [p for p in products if p.img], UPDATE_FIELDS[Product] + ['img'])
+            upsert(Product, [p for p in products if not p.img], UPDATE_FIELDS[Product])
+            ids = dict(Product.objects.filter(slug__in=links).values_list('slug', 'id'))
+            Through = Product.cat.through
+            Through.objects.bulk_create(
+                [Through(product_id=ids[slug], category_id=category_id)
+                 for slug, category_ids in links.items() for category_id in category_ids],
+                ignore_conflicts=True, batch_size=self.batch_size,
+            )
+            if self.reindex:
+                search.reindex(ids.values())
+        self.counts[Product] += len(products)
+
+    def finish(self):
+        self.flush()
+        # bulk_create не отправляет post_save, поэтому версия каталога сдвигается один раз в конце
+        bump_catalogue_version()
+        return self.counts
+
+
+def import_records(records, batch_size=1000, reindex=True):
+    """Импортирует пары (номер строки, запись) из read_records"""
+    importer = CatalogueImporter(batch_size=batch_size, reindex=reindex)
+    for line, record in records:
+        importer.add(record, line)
+    importer.finish()
+    return importer
+
+
+def export_records(batch_size=1000):
+    """Записи каталога в формате фида; в памяти не больше batch_size строк каждой модели"""
+    for category in Category.objects.order_by('pk').iterator(chunk_size=batch_size):
+        yield {'kind': 'category', 'slug': category.slug, 'title': category.title,
+               'description': category.description}
+    for author in Author.objects.order_by('pk').iterator(chunk_size=batch_size):
+        yield {'kind': 'author', 'slug': author.slug, 'name': author.name, 'about': author.about,
+               'birth_day': author.birth_day.isoformat() if author.birth_day else ''}
+    products = (Product.objects.select_related('author').only(
+        'slug', 'title', 'description', 'price', 'is_sale', 'img', 'author__slug')
+        .prefetch_related(Prefetch('cat', queryset=Category.objects.only('slug')))
+        .order_by('pk'))
+    for product in products.iterator(chunk_size=batch_size):
+        yield {'kind': 'product', 'slug': product.slug, 'title': product.title,
+               'description': product.description, 'price': str(product.price), 'is_sale': product.is_sale,
+               'img': product.img.name or '', 'author': product.author.slug,
+               'categories': [category.slug for category in product.cat.all()]}
+
+
+def write_records(records, stream, fmt):
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            if 'categories' in record:
+                record['categories'] = CATEGORY_SEPARATOR.join(record['categories'])
+            writer.writerow(record)
+    else:
+        for record in records:
+            stream.write(json.dumps(record, ensure_ascii=False))
+            stream.write('\n')
@@ -0,0 +1,14 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cache import get_cart_count, get_catalogue_version, get_fragment_timeout
+
+
+def catalogue(request):
+    return {
+        'catalogue_version': SimpleLazyObject(get_catalogue_version),
+        'fragment_timeout': get_fragment_timeout(),
+    }
+
+
+def cart(request):
+    return {'cart_count': get_cart_count(request)}
@@ -0,0 +1,113 @@
+"""
+Уменьшенные копии картинок товаров и аватаров для srcset.
+
+Варианты строятся фоновой задачей после сохранения Product/UserProfile и командой
+build_image_variants, а их имена и размеры хранятся в JSON-поле рядом с
+картинкой, поэтому шаблону не нужны лишние запросы:
+
+    {"source": "product/book1.png", "width": 600, "height": 900,
+     "formats": {"webp": [{"name": "...", "width": 160, "height": 240}, ...], ...}}
+"""
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, features
+
+# Формат: (расширение, MIME, параметры сохранения Pillow)
+FORMATS = {
+    'avif': ('avif', 'image/avif', {'quality': 50}),
+    'webp': ('webp', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def get_widths():
+    return getattr(settings, 'IMAGE_VARIANT_WIDTHS', (160, 320, 480))
+
+
+def supported_formats():
+    # AVIF и WebP есть не в каждой сборке Pillow, JPEG - всегда
+    available = set(features.get_supported_modules()) | {'jpeg'}
+    return [name for name in getattr(settings, 'IMAGE_VARIANT_FORMATS', ('avif', 'webp', 'jpeg'))
+            if name in available]
+
+
+def variant_name(source, width, extension):
+    directory, filename = os.path.split(source)
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, 'variants', f'{stem}-{width}w.{extension}')
+
+
+def build_variants(source, storage=default_storage):
+    """Строит варианты картинки source и возвращает их описание"""
+    with storage.open(source, 'rb') as f:
+        image = Image.open(f)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    result = {'source': source, 'width': image.width, 'height': image.height, 'formats': {}}
+    widths = [width for width in get_widths() if width < image.width] or [image.width]
+    for width in widths:
+        height = round(image.height * width / image.width)
+        resized = image.resize((width, height), Image.LANCZOS)
+        for fmt in supported_formats():
+            extension, _, options = FORMATS[fmt]
+            frame = resized.convert('RGB') if fmt == 'jpeg' else resized
+            buffer = io.BytesIO()
+            frame.save(buffer, format=fmt.upper(), **options)
+            # Хранилище может заменить имя (ContentAddressedStorage - на хэш содержимого),
+            # поэтому в JSON пишется имя, которое вернул save(); копии прежней
+            # картинки удаляет delete_stale_variants
+            name = storage.save(variant_name(source, width, extension), ContentFile(buffer.getvalue()))
+            result['formats'].setdefault(fmt, []).append({'name': name, 'width': width, 'height': height})
+    return result
+
+
+def needs_variants(instance, image_field, variants_field):
+    """Картинка сменилась или удалена, а варианты остались от прежней"""
+    image = getattr(instance, image_field)
+    variants = getattr(instance, variants_field) or {}
+    return variants.get('source') != image.name if image else bool(variants)
+
+
+def refresh_variants(instance, image_field, variants_field, force=False):
+    """Перестраивает варианты, если картинка сменилась; True, если было изменение"""
+    image = getattr(instance, image_field)
+    if not force and not needs_variants(instance, image_field, variants_field):
+        return False
+    old = getattr(instance, variants_field)
+    variants = build_variants(image.name, image.storage) if image else {}
+    save_variants(type(instance), instance.pk, variants_field, variants)
+    setattr(instance, variants_field, variants)
+    delete_stale_variants(type(instance), instance.pk, variants_field, old, variants, image.storage)
+    return True
+
+
+def save_variants(model, pk, variants_field, variants):
+    changes = {variants_field: variants}
+    if any(field.name == 'updated_at' for field in model._meta.concrete_fields):
+        # Меняется srcset страницы, Last-Modified должен сдвинуться
+        changes['updated_at'] = timezone.now()
+    model.objects.filter(pk=pk).update(**changes)
+
+
+def variant_names(variants):
+    return {variant['name'] for sizes in (variants or {}).get('formats', {}).values() for variant in sizes}
+
+
+def delete_stale_variants(model, pk, variants_field, old, new, storage=default_storage):
+    """Удаляет копии прежней картинки после сохранения новых, возвращает их кол-во"""
+    stale = variant_names(old) - variant_names(new)
+    source = (old or {}).get('source')
+    # Одинаковые картинки дают одни и те же файлы копий: пока у другой записи
+    # тот же источник, копии общие и остаются
+    if not stale or model.objects.filter(**{f'{variants_field}__source': source}).exclude(pk=pk).exists():
+        return 0
+    for name in stale:
+        storage.delete(name)
+    return len(stale)
@@ -0,0 +1,174 @@
+"""
+Фоновые задачи в таблице Job, без отдельного брокера.
+
+    @job(max_attempts=3)
+    def reindex_products(product_ids):
+        ...
+
+    reindex_products.delay([product.pk])
+
+delay() добавляет строку Job в текущей транзакции: если транзакция
+откатится, задачи не будет, а воркер увидит ее только после коммита.
+manage.py run_jobs забирает задачи через SELECT ... FOR UPDATE SKIP LOCKED,
+так что несколько воркеров не берут одну задачу и не ждут друг друга.
+Выполненная задача удаляется, упавшая повторяется с растущей паузой, после
+max_attempts остается со статусом failed и текстом ошибки. Задача, которая
+выполняется дольше stale_after, считается брошенной убитым воркером и
+возвращается в очередь (или становится failed, если попытки кончились), поэтому
+для долгих задач stale_after задается больше их обычного времени:
+
+    @job(stale_after=60 * 60)
+    def build_sitemap():
+        ...
+
+JOB_RUNNER = 'inline' выполняет задачи сразу после коммита в том же
+процессе - для разработки и тестов без воркера. Аргументы и тогда проходят
+через JSON, а ошибка задачи пишется в лог, а не в ответ уже закоммиченного запроса.
+"""
+import json
+import logging
+import random
+import traceback
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger('mainpage.jobs')
+
+# Пауза перед повтором: BACKOFF_BASE * 2 ** (попытка - 1), не больше BACKOFF_MAX секунд
+BACKOFF_BASE = 10
+BACKOFF_MAX = 60 * 60
+# Задача в статусе running дольше этого (воркер убит) возвращается в очередь, секунд;
+# по умолчанию для задач без своего stale_after
+STALE_AFTER = 15 * 60
+
+
+def job(func=None, *, max_attempts=5, stale_after=None):
+    """Делает функцию фоновой задачей: func.delay(*args, **kwargs) ставит ее в очередь.
+
+    Аргументы сохраняются в JSON, поэтому передаются id, а не объекты моделей.
+    """
+    if func is None:
+        return lambda func: job(func, max_attempts=max_attempts, stale_after=stale_after)
+
+    name = f'{func.__module__}.{func.__qualname__}'
+
+    def delay(*args, **kwargs):
+        if getattr(settings, 'JOB_RUNNER', 'db') == 'inline':
+            # Тот же JSON, что и в таблице: аргументы, которые не сохранятся, видны и в разработке
+            stored_args, stored_kwargs = json.loads(json.dumps([list(args), kwargs]))
+            transaction.on_commit(lambda: run_inline(func, stored_args, stored_kwargs))
+            return None
+        return Job.objects.create(name=name, args=list(args), kwargs=kwargs, max_attempts=max_attempts)
+
+    func.delay = delay
+    func.job_name = name
+    func.stale_after = stale_after
+    return func
+
+
+def run_inline(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception('Задача %s упала', func.job_name)
+
+
+def resolve(name):
+    module, _, attr = name.rpartition('.')
+    func = getattr(import_module(module), attr, None)
+    if getattr(func, 'job_name', None) != name:
+        # В таблице может оказаться что угодно, выполняются только функции с @job
+        raise LookupError(f'{name} не зарегистрирована через @job')
+    return func
+
+
+def claim(worker):
+    """Берет следующую готовую задачу и помечает ее running, иначе None"""
+    now = timezone.now()
+    with transaction.atomic():
+        queued = Job.objects.filter(status=Job.QUEUED, run_at__lte=now).order_by('run_at', 'pk')
+        if connection.features.has_select_for_update_skip_locked:
+            queued = queued.select_for_update(skip_locked=True)
+        task = queued.first()
+        if task is None:
+            return None
+        # Без SKIP LOCKED (SQLite) задачу забирает тот, чей UPDATE прошел первым
+        claimed = Job.objects.filter(pk=task.pk, status=Job.QUEUED).update(
+            status=Job.RUNNING, locked_at=now, locked_by=worker, attempts=task.attempts + 1)
+    if not claimed:
+        return None
+    task.status, task.locked_at, task.locked_by = Job.RUNNING, now, worker
+    task.attempts += 1
+    return task
+
+
+def get_backoff(attempts):
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    # Разброс, чтобы задачи, упавшие вместе, не повторялись вместе
+    return delay * random.uniform(0.8, 1.2)
+
+
+def execute(task):
+    """Выполняет задачу; True, если успешно
+
+    Итог пишется, только пока задача за этим воркером: брошенную им задачу
+    requeue_stale мог вернуть в очередь, и ее уже взял другой.
+    """
+    owned = Job.objects.filter(pk=task.pk, status=Job.RUNNING, locked_by=task.locked_by)
+    try:
+        resolve(task.name)(*task.args, **task.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        if task.attempts >= task.max_attempts:
+            logger.error('Задача %s окончательно упала после %d попыток:\n%s', task, task.attempts, error)
+            owned.update(status=Job.FAILED, last_error=error, locked_at=None)
+        else:
+            logger.warning('Задача %s упала, попытка %d:\n%s', task, task.attempts, error)
+            owned.update(
+                status=Job.QUEUED, last_error=error, locked_at=None, locked_by='',
+                run_at=timezone.now() + timedelta(seconds=get_backoff(task.attempts)))
+        return False
+    owned.delete()
+    return True
+
+
+def get_stale_after(name):
+    default = getattr(settings, 'JOB_STALE_AFTER', STALE_AFTER)
+    try:
+        return resolve(name).stale_after or default
+    except (ImportError, LookupError):
+        return default
+
+
+def requeue_stale():
+    """Возвращает в очередь задачи воркеров, которые умерли посреди выполнения
+
+    Попытка уже засчитана при claim: задача, у которой попытки кончились,
+    становится failed, иначе задача, убивающая воркер, повторялась бы вечно.
+    """
+    now = timezone.now()
+    retry, exhausted = [], []
+    # Выполняющихся задач не больше, чем воркеров, поэтому срок проверяется в Python
+    running = Job.objects.filter(status=Job.RUNNING).values_list('pk', 'name', 'locked_at', 'attempts', 'max_attempts')
+    for pk, name, locked_at, attempts, max_attempts in running:
+        if locked_at is None or locked_at >= now - timedelta(seconds=get_stale_after(name)):
+            continue
+        (exhausted if attempts >= max_attempts else retry).append(pk)
+    requeued = Job.objects.filter(pk__in=retry, status=Job.RUNNING).update(
+        status=Job.QUEUED, locked_at=None, locked_by='')
+    if exhausted:
+        logger.error('Задачи %s брошены воркером на последней попытке', exhausted)
+    failed = Job.objects.filter(pk__in=exhausted, status=Job.RUNNING).update(
+        status=Job.FAILED, locked_at=None, last_error='Воркер не завершил задачу за stale_after')
+    return requeued + failed
+
+
+def retry_failed(queryset):
+    return queryset.filter(status=Job.FAILED).update(
+        status=Job.QUEUED, attempts=0, run_at=timezone.now(), last_error='')
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.staticfiles.handlers import StaticFilesHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.testcases import LiveServerThread
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from mainpage import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный прогон витрины на тестовой БД с синтетическим каталогом: '
+            'перцентили времени, запросы к БД, память; сравнение с baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--authors', type=int, default=200)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--ratings', type=int, default=20000)
+        parser.add_argument('--carts', type=int, default=200)
+        parser.add_argument('--iterations', type=int, default=50, help='Запросов на сценарий')
+        parser.add_argument('--only', nargs='+', help='Имена сценариев')
+        parser.add_argument('--live', action='store_true',
+                            help='Дополнительно гонять GET-сценарии по HTTP через живой сервер')
+        parser.add_argument('--concurrency', type=int, default=4, help='Потоков в режиме --live')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Не удалять тестовую БД, повторный запуск не заполняет ее заново')
+        parser.add_argument('--output', help='Куда записать результаты в JSON')
+        parser.add_argument('--baseline', help='JSON прошлого прогона; регрессия - ошибка команды')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Допустимый рост p95, доля')
+
+    def handle(self, *args, **options):
+        # SQLite по умолчанию создает тестовую БД в памяти, а живому серверу нужен файл
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'bookshop_bench.sqlite3')
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'], serialize=False)
+        try:
+            # Отдельный кэш в памяти, чтобы не трогать общий кэш и начинать с пустого
+            caches = dict(settings.CACHES, shared={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'})
+            with override_settings(CACHES=caches, ALLOWED_HOSTS=['*'], DEBUG=False):
+                results = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        self.report(results)
+        data = {'scenarios': results, 'options': {key: options[key] for key in (
+            'products', 'authors', 'categories', 'ratings', 'carts', 'iterations')}}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+                f.write('\n')
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                problems = benchmark.compare(results, json.load(f), options['tolerance'], options['only'])
+            if problems:
+                raise CommandError('Регрессии:\n' + '\n'.join(problems))
+            self.stdout.write(self.style.SUCCESS('Регрессий относительно baseline нет'))
+
+    def run(self, options):
+        if benchmark.seed(products=options['products'], authors=options['authors'],
+                          categories=options['categories'], ratings=options['ratings'], carts=options['carts']):
+            self.stdout.write('Каталог заполнен')
+        scenarios = benchmark.get_scenarios()
+        if options['only']:
+            scenarios = [s for s in scenarios if s.name in options['only']]
+        results = benchmark.run_client(scenarios, iterations=options['iterations'])
+        results.update(benchmark.run_templates(scenarios, iterations=options['iterations']))
+
+        if options['live']:
+            server = LiveServerThread('localhost', StaticFilesHandler)
+            server.daemon = True
+            server.start()
+            server.is_ready.wait()
+            if server.error:
+                raise server.error
+            try:
+                results.update(benchmark.run_live(f'http://localhost:{server.port}', scenarios,
+                                                  iterations=options['iterations'],
+                                                  concurrency=options['concurrency']))
+            finally:
+                server.terminate()
+        return results
+
+    def report(self, results):
+        self.stdout.write(f'{"сценарий":<22}{"n":>6}{"p50":>9}{"p95":>9}{"p99":>9}{"max":>9}'
+                          f'{"запросы":>9}{"КБ":>9}')
+        for name, row in results.items():
+            self.stdout.write(
+                f'{name:<22}{row["n"]:>6}{row["p50"]:>9.2f}{row["p95"]:>9.2f}{row["p99"]:>9.2f}{row["max"]:>9.2f}'
+                f'{row.get("queries", "-"):>9}{row.get("alloc_kb", "-"):>9}'
+            )
@@ -0,0 +1,61 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from mainpage.cache import bump_catalogue_version
+from mainpage.images import build_variants, delete_stale_variants, save_variants
+from mainpage.models import Product, UserProfile
+
+# Модель, поле картинки, поле с вариантами
+TARGETS = (
+    (Product, 'img', 'img_variants'),
+    (UserProfile, 'avatar', 'avatar_variants'),
+)
+
+
+def build(source):
+    # Выполняется в дочернем процессе: только файлы, без обращений к БД
+    return build_variants(source)
+
+
+class Command(BaseCommand):
+    help = 'Строит уменьшенные копии картинок товаров и аватаров в пуле процессов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Число процессов')
+        parser.add_argument('--force', action='store_true',
+                            help='Перестроить и те картинки, у которых копии уже есть')
+
+    def handle(self, *args, **options):
+        jobs = []
+        for model, image_field, variants_field in TARGETS:
+            rows = model.objects.exclude(**{image_field: ''}).values_list('pk', image_field, variants_field)
+            for pk, source, variants in rows.iterator():
+                if options['force'] or (variants or {}).get('source') != source:
+                    jobs.append((model, variants_field, pk, source, variants))
+        self.stdout.write(f'Картинок к обработке: {len(jobs)}')
+        if not jobs:
+            return
+
+        # Соединения с БД не должны переходить в дочерние процессы
+        connections.close_all()
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {pool.submit(build, source): (model, field, pk, source, old)
+                       for model, field, pk, source, old in jobs}
+            for future in as_completed(futures):
+                model, field, pk, source, old = futures[future]
+                try:
+                    variants = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{source}: {e}')
+                    continue
+                save_variants(model, pk, field, variants)
+                delete_stale_variants(model, pk, field, old, variants)
+                done += 1
+        bump_catalogue_version()
+        self.stdout.write(self.style.SUCCESS(f'Готово: {done}, ошибок: {failed}'))
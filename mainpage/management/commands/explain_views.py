@@ -0,0 +1,102 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+
+from mainpage.models import Category, Product, RatingStar
+
+# Маленькие справочники, полный просмотр которых нормален
+SMALL_TABLES = ('mainpage_category', 'mainpage_ratingstar', 'django_content_type')
+
+
+def explain(sql, params):
+    """Строки плана запроса и признаки полного просмотра таблицы и сортировки без индекса"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            lines = [row[-1] for row in cursor.fetchall()]
+            sorts = [line for line in lines if 'TEMP B-TREE' in line]
+            scans = [line for line in lines
+                     if line.startswith('SCAN ') and ' USING ' not in line and 'CONSTANT ROW' not in line]
+            # Просмотр таблицы в порядке rowid с LIMIT и без сортировки останавливается на первых строках
+            if scans and not sorts and ' LIMIT ' in sql:
+                scans = []
+        elif connection.vendor == 'mysql':
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            lines = [f'{row["table"]}: type={row["type"]} key={row["key"]} rows={row["rows"]} {row["Extra"] or ""}'
+                     for row in rows]
+            scans = [line for line, row in zip(lines, rows) if row['type'] == 'ALL']
+            sorts = [line for line, row in zip(lines, rows) if 'filesort' in (row['Extra'] or '')]
+        else:
+            cursor.execute('EXPLAIN ' + sql, params)
+            lines = [row[0] for row in cursor.fetchall()]
+            scans = [line.strip() for line in lines if 'Seq Scan' in line]
+            sorts = [line.strip() for line in lines if 'Sort Key' in line]
+    return lines, scans, sorts
+
+
+class Command(BaseCommand):
+    help = ('Открывает основные страницы каталога и корзины, выполняет EXPLAIN для каждого их '
+            'SQL-запроса и сообщает о полных просмотрах таблиц. Изменения в БД откатываются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true', help='Печатать планы всех запросов')
+        parser.add_argument('--ignore-table', nargs='*', default=SMALL_TABLES,
+                            help='Таблицы, полный просмотр которых допустим')
+
+    def get_checks(self):
+        product = Product.objects.for_sale().order_by('-pk').first()
+        category = Category.objects.order_by('pk').first()
+        star = RatingStar.objects.order_by('pk').first()
+        if product is None or category is None or star is None:
+            raise CommandError('Нужен хотя бы один товар, категория и звезда рейтинга')
+        word = product.title.split()[0]
+        return [
+            ('mainpage', 'get', '/', None),
+            ('product_list', 'get', '/products', None),
+            ('product_list:keyset', 'get', f'/products?after={product.pk}', None),
+            ('category', 'get', category.get_absolute_url(), None),
+            ('product_det', 'get', product.get_absolute_url(), None),
+            ('search', 'get', f'/search/?q={word}', None),
+            ('search_suggest', 'get', f'/search/suggest/?q={word[:3]}', None),
+            ('cart:add', 'post', '/cart/', {'p_id': product.pk, 'qty': 1}),
+            ('cart', 'get', '/cart/', None),
+            ('add_rating', 'post', '/add-rating/', {'star': star.pk, 'product': product.pk}),
+        ]
+
+    def handle(self, *args, **options):
+        problems = []
+        with override_settings(ALLOWED_HOSTS=['*'], PAGE_CACHE_ENABLED=False), transaction.atomic():
+            client = Client()
+            client.force_login(User.objects.create_user('explain-views-check', password=None))
+            for name, method, path, data in self.get_checks():
+                captured = []
+
+                def capture(execute, sql, params, many, context):
+                    if sql.lstrip().upper().startswith('SELECT') and not many:
+                        captured.append((sql, params))
+                    return execute(sql, params, many, context)
+
+                with connection.execute_wrapper(capture):
+                    response = getattr(client, method)(path, data)
+                self.stdout.write(f'{name} {path}: {response.status_code}, SELECT-запросов {len(captured)}')
+                for sql, params in captured:
+                    lines, scans, sorts = explain(sql, params)
+                    scans = [line for line in scans if not any(table in line for table in options['ignore_table'])]
+                    if options['verbose_plans'] or scans:
+                        self.stdout.write(f'  {sql[:200]}')
+                        for line in lines:
+                            self.stdout.write(f'    {line}')
+                    for line in scans:
+                        problems.append(f'{name}: полный просмотр - {line}')
+                        self.stdout.write(self.style.ERROR(f'  полный просмотр: {line}'))
+                    for line in sorts:
+                        self.stdout.write(self.style.WARNING(f'  сортировка без индекса: {line}'))
+            transaction.set_rollback(True)
+
+        if problems:
+            raise CommandError('Запросы с полным просмотром таблиц:\n' + '\n'.join(problems))
+        self.stdout.write(self.style.SUCCESS('Полных просмотров таблиц нет'))
@@ -0,0 +1,27 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from mainpage import catalogue_feed
+
+
+class Command(BaseCommand):
+    help = 'Выгружает каталог в CSV/JSONL-фид, читая БД пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Файл фида, "-" - stdout')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Формат фида, по умолчанию по расширению файла')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько строк читать из БД за раз')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = catalogue_feed.detect_format(path, options['format'])
+        records = catalogue_feed.export_records(batch_size=options['batch_size'])
+        if path == '-':
+            catalogue_feed.write_records(records, sys.stdout, fmt)
+            return
+        with open(path, 'w', encoding='utf-8', newline='') as stream:
+            catalogue_feed.write_records(records, stream, fmt)
+        self.stdout.write(self.style.SUCCESS(f'Каталог выгружен в {path}'))
@@ -0,0 +1,33 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mainpage import ratings
+
+
+class Command(BaseCommand):
+    help = ('Записывает оценки из буфера (RATING_WRITE_MODE = buffered) в БД пачками. '
+            'Без --once работает постоянно, раз в RATING_FLUSH_INTERVAL секунд')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Записать накопленное и выйти')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Пауза между записями, секунд (по умолчанию RATING_FLUSH_INTERVAL)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            interval = getattr(settings, 'RATING_FLUSH_INTERVAL', 5)
+        while True:
+            read, written = ratings.flush(options['batch_size'])
+            if read or options['once']:
+                self.stdout.write(f'Голосов: {read}, записано оценок: {written}, '
+                                  f'в буфере: {ratings.pending()}')
+            if options['once']:
+                return
+            # Соединение с БД не должно пережить перезапуск MySQL между проходами
+            close_old_connections()
+            time.sleep(interval)
@@ -0,0 +1,43 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mainpage import catalogue_feed
+
+
+class Command(BaseCommand):
+    help = 'Импортирует категории, авторов и товары из CSV/JSONL-фида пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл фида, "-" - stdin')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Формат фида, по умолчанию по расширению файла')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько записей писать одним INSERT')
+        parser.add_argument('--no-reindex', action='store_true',
+                            help='Не обновлять поисковый индекс (потом rebuild_search_index)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = catalogue_feed.detect_format(path, options['format'])
+        try:
+            stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+        except OSError as e:
+            raise CommandError(e)
+        try:
+            importer = catalogue_feed.import_records(
+                catalogue_feed.read_records(stream, fmt),
+                batch_size=options['batch_size'], reindex=not options['no_reindex'],
+            )
+        finally:
+            # stdin открыт не командой, закрывать его не нам
+            if stream is not sys.stdin:
+                stream.close()
+
+        for where, message in importer.errors[:50]:
+            self.stderr.write(f'{where}: {message}')
+        if len(importer.errors) > 50:
+            self.stderr.write(f'... и еще {len(importer.errors) - 50} ошибок')
+        counts = ', '.join(f'{model._meta.verbose_name_plural}: {n}' for model, n in importer.counts.items())
+        self.stdout.write(self.style.SUCCESS(f'Импортировано - {counts}; пропущено записей: {len(importer.errors)}'))
+        self.stdout.write('Уменьшенные копии новых картинок строит команда build_image_variants')
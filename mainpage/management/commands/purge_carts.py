@@ -0,0 +1,52 @@
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from mainpage.cart import expired_anonymous_carts
+
+
+def purge(queryset, batch_size, pause):
+    """Удаляет строки queryset пачками по первичному ключу, каждая пачка - короткий DELETE"""
+    deleted = 0
+    while True:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        with transaction.atomic():
+            # delete() удаляет собранные строки по pk, без условия queryset, поэтому условие
+            # проверяется заново под блокировкой: корзина, измененная после выборки, остается,
+            # а заблокированную до конца удаления никто не изменит
+            locked = list(queryset.filter(pk__in=pks).select_for_update().values_list('pk', flat=True))
+            deleted += queryset.filter(pk__in=locked).delete()[1].get(queryset.model._meta.label, 0)
+        if len(pks) < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+class Command(BaseCommand):
+    help = ('Удаляет брошенные корзины сессий (CART_ANONYMOUS_TTL) и истекшие сессии '
+            'небольшими пачками с паузами, чтобы не держать долгих блокировок')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0.1, help='Пауза между пачками, секунд')
+        parser.add_argument('--ttl', type=int, default=None,
+                            help='Срок корзины сессии, секунд (по умолчанию CART_ANONYMOUS_TTL)')
+
+    def handle(self, *args, **options):
+        carts = purge(expired_anonymous_carts(options['ttl']), options['batch_size'], options['pause'])
+        self.stdout.write(f'Удалено корзин: {carts}')
+
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        if hasattr(store, 'get_model_class'):
+            expired = store.get_model_class().objects.filter(expire_date__lt=timezone.now())
+            sessions = purge(expired, options['batch_size'], options['pause'])
+            self.stdout.write(f'Удалено сессий: {sessions}')
+        else:
+            # Сессии в кэше или cookie истекают сами
+            store.clear_expired()
+        self.stdout.write(self.style.SUCCESS('Готово'))
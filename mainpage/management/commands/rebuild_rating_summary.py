@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from mainpage.models import ProductRatingSummary
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сводки рейтинга товаров с нуля по таблице Rating'
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int,
+                            help='Пересчитать только указанные товары')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        product_ids = options['product_ids'] or None
+        count = ProductRatingSummary.rebuild(product_ids, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано сводок: {count}'))
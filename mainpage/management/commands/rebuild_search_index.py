@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from mainpage import search
+from mainpage.models import SearchEntry
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Сколько товаров индексировать за одну транзакцию')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        SearchEntry.objects.all().delete()
+        products = search.indexable_products()
+        last_pk, indexed, entries = 0, 0, 0
+        while True:
+            batch = list(products.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            entries += search.index_products(batch)
+            indexed += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f'Проиндексировано товаров: {indexed}')
+        self.stdout.write(self.style.SUCCESS(f'Готово: {indexed} товаров, {entries} записей индекса'))
@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections, connections
+
+from mainpage import jobs
+
+# Как часто воркер ищет задачи зависших воркеров, секунд
+REQUEUE_INTERVAL = 60
+
+
+def work(worker, stop, poll_interval, once):
+    """Цикл одного воркера: берет задачи, пока не будет stop"""
+    next_requeue = 0
+    while not stop.is_set():
+        try:
+            if time.monotonic() >= next_requeue:
+                jobs.requeue_stale()
+                next_requeue = time.monotonic() + REQUEUE_INTERVAL
+            task = jobs.claim(worker)
+            if task is not None:
+                jobs.execute(task)
+        except DatabaseError:
+            # БД недоступна или занята: воркер ждет и пробует снова, а не умирает
+            jobs.logger.exception('Воркер %s: ошибка БД', worker)
+            stop.wait(poll_interval)
+            continue
+        finally:
+            # Соединение не должно жить дольше CONN_MAX_AGE и переживать ошибки
+            close_old_connections()
+        if task is None:
+            if once:
+                return
+            stop.wait(poll_interval)
+
+
+def work_in_process(worker, stop, poll_interval, once):
+    # Ctrl+C получает вся группа процессов, останавливает их родитель через stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    work(worker, stop, poll_interval, once)
+
+
+class Command(BaseCommand):
+    help = 'Выполняет фоновые задачи из таблицы Job в нескольких потоках или процессах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Число воркеров')
+        parser.add_argument('--processes', action='store_true',
+                            help='Воркеры - процессы, а не потоки (для задач, нагружающих CPU)')
+        parser.add_argument('--poll-interval', type=float, default=1,
+                            help='Пауза, когда очередь пуста, секунд')
+        parser.add_argument('--once', action='store_true', help='Выполнить готовые задачи и выйти')
+
+    def handle(self, *args, **options):
+        name = f'{socket.gethostname()}:{os.getpid()}'
+        if options['processes']:
+            # Соединения с БД не должны переходить в дочерние процессы
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            stop = context.Event()
+            workers = [context.Process(target=work_in_process, args=(f'{name}:{i}', stop, options['poll_interval'],
+                                                                     options['once']))
+                       for i in range(options['workers'])]
+        else:
+            stop = threading.Event()
+            workers = [threading.Thread(target=work, args=(f'{name}:{i}', stop, options['poll_interval'],
+                                                           options['once']))
+                       for i in range(options['workers'])]
+
+        def shutdown(signum, frame):
+            self.stdout.write('Останавливаемся после текущих задач')
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        self.stdout.write(f'Воркеров: {len(workers)}')
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.stdout.write(self.style.SUCCESS('Готово'))
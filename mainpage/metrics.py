@@ -0,0 +1,251 @@
+"""
+Стоимость запросов по именам URL: SQL-запросы и время БД, попадания в кэш,
+время шаблонов и вида.
+
+Счетчики текущего запроса лежат в contextvar, поэтому учитываются и запросы
+из потоков sync_to_async (mainpage/async_views.py). Итоги копятся в памяти
+процесса и отдаются в формате Prometheus на /metrics/: каждый воркер
+gunicorn считает свое, Prometheus собирает их по отдельности.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates
+from django.test.utils import CaptureQueriesContext
+
+from bookshop.cache import request_stats as cache_request_stats
+from bookshop.db.mysql_pool.pool import pool_stats
+
+# Границы гистограммы длительности запросов, секунд
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Сколько самых медленных SQL попадает в лог медленного запроса
+SLOW_LOG_QUERIES = 5
+MAX_RECORDED_QUERIES = 200
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.cache = {}
+        self.sql = []
+
+    @property
+    def cache_hits(self):
+        return self.cache.get('l1_hits', 0) + self.cache.get('l2_hits', 0)
+
+    @property
+    def cache_misses(self):
+        return self.cache.get('misses', 0)
+
+
+current = ContextVar('request_stats', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    stats = current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        stats.queries += 1
+        stats.db_time += duration
+        if len(stats.sql) < MAX_RECORDED_QUERIES:
+            stats.sql.append((duration, sql))
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_wrapper)
+
+
+class TimedTemplate:
+    """Шаблон, время рендера которого попадает в RequestStats"""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        stats = current.get()
+        if stats is None:
+            return self.template.render(context, request)
+        # Вложенный render_to_string уже учтен во времени внешнего шаблона
+        stats.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            stats.template_depth -= 1
+            if not stats.template_depth:
+                stats.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """DjangoTemplates с учетом времени рендера в метриках запроса"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+POOL_METRICS = (
+    ('size', 'gauge', 'Размер пула соединений'),
+    ('in_use', 'gauge', 'Выданные соединения'),
+    ('idle', 'gauge', 'Свободные соединения'),
+    ('waiting', 'gauge', 'Потоки, ждущие соединение'),
+    ('acquired', 'counter', 'Выдачи соединений'),
+    ('created', 'counter', 'Открытые соединения'),
+    ('discarded', 'counter', 'Закрытые неисправные соединения'),
+    ('timeouts', 'counter', 'Отказы по таймауту ожидания'),
+    ('wait_seconds', 'counter', 'Суммарное ожидание соединения, с'),
+)
+
+
+def render_pool_stats():
+    """Насыщение пулов соединений (DB_POOL=1) процесса"""
+    stats = pool_stats()
+    lines = []
+    for field, kind, description in POOL_METRICS if stats else ():
+        name = f'bookshop_db_pool_{field}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{alias="{alias}"}} {row[field]:g}' for alias, row in sorted(stats.items())]
+    return lines
+
+
+class Registry:
+    """Накопленные метрики процесса по именам URL"""
+
+    FIELDS = ('requests', 'queries', 'db_seconds', 'template_seconds', 'view_seconds',
+              'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def observe(self, route, stats, duration, status):
+        with self.lock:
+            row = self.routes.get(route)
+            if row is None:
+                row = self.routes[route] = dict.fromkeys(self.FIELDS, 0)
+                row['buckets'] = [0] * len(BUCKETS)
+                row['statuses'] = {}
+            row['requests'] += 1
+            row['queries'] += stats.queries
+            row['db_seconds'] += stats.db_time
+            row['template_seconds'] += stats.template_time
+            row['view_seconds'] += duration - stats.template_time
+            row['cache_hits'] += stats.cache_hits
+            row['cache_misses'] += stats.cache_misses
+            row['statuses'][status] = row['statuses'].get(status, 0) + 1
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    row['buckets'][i] += 1
+
+    def render(self):
+        with self.lock:
+            routes = {route: dict(row, buckets=list(row['buckets']), statuses=dict(row['statuses']))
+                      for route, row in self.routes.items()}
+        lines = []
+        counters = (
+            ('queries', 'SQL-запросы'),
+            ('db_seconds', 'Время в БД, с'),
+            ('template_seconds', 'Время рендера шаблонов, с'),
+            ('view_seconds', 'Время вида без шаблонов, с'),
+            ('cache_hits', 'Попадания в кэш'),
+            ('cache_misses', 'Промахи кэша'),
+        )
+        lines += ['# HELP bookshop_requests_total Запросы', '# TYPE bookshop_requests_total counter']
+        for route, row in sorted(routes.items()):
+            for status, n in sorted(row['statuses'].items()):
+                lines.append(f'bookshop_requests_total{{route="{route}",status="{status}"}} {n}')
+        for field, description in counters:
+            name = f'bookshop_{field}_total'
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            lines += [f'{name}{{route="{route}"}} {row[field]:g}' for route, row in sorted(routes.items())]
+        name = 'bookshop_request_duration_seconds'
+        lines += [f'# HELP {name} Длительность запроса', f'# TYPE {name} histogram']
+        for route, row in sorted(routes.items()):
+            for bound, n in zip(BUCKETS, row['buckets']):
+                lines.append(f'{name}_bucket{{route="{route}",le="{bound:g}"}} {n}')
+            lines.append(f'{name}_bucket{{route="{route}",le="+Inf"}} {row["requests"]}')
+            lines.append(f'{name}_sum{{route="{route}"}} {row["view_seconds"] + row["template_seconds"]:g}')
+            lines.append(f'{name}_count{{route="{route}"}} {row["requests"]}')
+        lines += render_pool_stats()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@contextmanager
+def collect():
+    """Собирает RequestStats для кода внутри блока"""
+    stats = RequestStats()
+    token = current.set(stats)
+    cache_token = cache_request_stats.set(stats.cache)
+    try:
+        yield stats
+    finally:
+        current.reset(token)
+        cache_request_stats.reset(cache_token)
+
+
+def server_timing(stats, duration, detailed=True):
+    """Значение Server-Timing; без detailed - только общее время, без числа запросов и кэша"""
+    if not detailed:
+        return f'total;dur={duration * 1000:.1f}'
+    return ', '.join([
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"',
+        f'cache;desc="{stats.cache_hits} hits, {stats.cache_misses} misses"',
+        f'tpl;dur={stats.template_time * 1000:.1f}',
+        f'view;dur={(duration - stats.template_time) * 1000:.1f}',
+        f'total;dur={duration * 1000:.1f}',
+    ])
+
+
+def is_slow(duration):
+    threshold = getattr(settings, 'SLOW_REQUEST_MS', 500)
+    if threshold is None or duration * 1000 < threshold:
+        return False
+    return random.random() < getattr(settings, 'SLOW_REQUEST_SAMPLE_RATE', 1.0)
+
+
+def slowest_queries(stats, limit=SLOW_LOG_QUERIES):
+    return sorted(stats.sql, key=lambda item: item[0], reverse=True)[:limit]
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(limit, using='default'):
+    """Проверка в тестах: код внутри блока делает не больше limit запросов к БД
+
+        with query_budget(6):
+            client.get('/products')
+    """
+    with CaptureQueriesContext(connections[using]) as captured:
+        yield captured
+    if len(captured) > limit:
+        queries = '\n'.join(f'{i}. {query["sql"]}' for i, query in enumerate(captured.captured_queries, 1))
+        raise QueryBudgetExceeded(f'{len(captured)} запросов к БД при бюджете {limit}:\n{queries}')
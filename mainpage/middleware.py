@@ -0,0 +1,69 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import metrics
+from .cart import CART_COOKIE
+
+slow_log = logging.getLogger('mainpage.slow_requests')
+
+
+class CartCookieMiddleware:
+    """Убирает cookie анонимной корзины после ее переноса в БД при входе"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        merged_cart = getattr(request, 'merged_cart', None)
+        if merged_cart is not None:
+            response.delete_cookie(CART_COOKIE)
+            response.set_cookie('cart_count', merged_cart.items_count)
+        return response
+
+
+class MetricsMiddleware:
+    """Стоимость запроса: заголовок Server-Timing, счетчики по имени URL и лог медленных запросов"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with metrics.collect() as stats:
+            start = time.perf_counter()
+            response = self.get_response(request)
+            self.finish(request, response, stats, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        with metrics.collect() as stats:
+            start = time.perf_counter()
+            response = await self.get_response(request)
+            self.finish(request, response, stats, time.perf_counter() - start)
+        return response
+
+    def finish(self, request, response, stats, duration):
+        match = request.resolver_match
+        route = match.view_name if match else 'unresolved'
+        metrics.registry.observe(route, stats, duration, response.status_code)
+        if getattr(settings, 'SERVER_TIMING', True):
+            # Число запросов и попадания в кэш видны только при DEBUG, персоналу
+            # и при SERVER_TIMING_DETAILED (замер шаблонов в manage.py benchmark)
+            user = getattr(request, 'user', None)
+            detailed = (settings.DEBUG or getattr(settings, 'SERVER_TIMING_DETAILED', False)
+                        or bool(user and user.is_staff))
+            response['Server-Timing'] = metrics.server_timing(stats, duration, detailed)
+        if metrics.is_slow(duration):
+            queries = ''.join(f'\n  {d * 1000:.1f} мс: {sql}' for d, sql in metrics.slowest_queries(stats))
+            slow_log.warning('%s %s (%s): %.0f мс, запросов %d, БД %.0f мс, шаблоны %.0f мс%s',
+                             request.method, request.get_full_path(), route, duration * 1000,
+                             stats.queries, stats.db_time * 1000, stats.template_time * 1000, queries)
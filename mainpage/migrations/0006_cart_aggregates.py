@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:46
+
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+
+
+def recalculate_carts(apps, schema_editor):
+    Cart = apps.get_model('mainpage', 'Cart')
+    for cart in Cart.objects.annotate(
+            content_total=Sum(F('cartcontent__product__price') * F('cartcontent__qty'),
+                              output_field=models.DecimalField(max_digits=12, decimal_places=2)),
+            content_count=Count('cartcontent')).iterator():
+        cart.total_cost = cart.content_total or 0
+        cart.items_count = cart.content_count
+        cart.save(update_fields=['total_cost', 'items_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainpage', '0005_cart_cartcontent_remove_orderitem_order_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='items_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Кол-во позиций'),
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Сумма'),
+        ),
+        migrations.RunPython(recalculate_carts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:47
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    Rating = apps.get_model('mainpage', 'Rating')
+    ProductRatingSummary = apps.get_model('mainpage', 'ProductRatingSummary')
+    summaries = {}
+    rows = Rating.objects.values_list('product_id', 'star__value').annotate(n=Count('id')).order_by()
+    for product_id, value, n in rows.iterator():
+        summary = summaries.setdefault(product_id, ProductRatingSummary(product_id=product_id, histogram={}))
+        summary.histogram[str(value)] = n
+        summary.stars_sum += value * n
+        summary.votes += n
+    for summary in summaries.values():
+        summary.average = round(summary.stars_sum / summary.votes, 2)
+    ProductRatingSummary.objects.bulk_create(summaries.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainpage', '0006_cart_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRatingSummary',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_summary', serialize=False, to='mainpage.product', verbose_name='Продукт')),
+                ('stars_sum', models.PositiveIntegerField(default=0, verbose_name='Сумма оценок')),
+                ('votes', models.PositiveIntegerField(default=0, verbose_name='Кол-во оценок')),
+                ('average', models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=4, verbose_name='Средняя оценка')),
+                ('histogram', models.JSONField(default=dict, verbose_name='Распределение оценок')),
+            ],
+            options={
+                'verbose_name': 'Сводка рейтинга',
+                'verbose_name_plural': 'Сводки рейтинга',
+            },
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
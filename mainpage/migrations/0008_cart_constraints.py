@@ -0,0 +1,64 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:52
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    Cart = apps.get_model('mainpage', 'Cart')
+    CartContent = apps.get_model('mainpage', 'CartContent')
+
+    Cart.objects.filter(session_key='').update(session_key=None)
+
+    # Несколько корзин одного пользователя или сессии сливаются в самую раннюю
+    for field in ('user_id', 'session_key'):
+        duplicates = (Cart.objects.exclude(**{field: None}).values(field)
+                      .annotate(n=Count('id'), keep=Min('id')).filter(n__gt=1))
+        for row in duplicates:
+            others = Cart.objects.filter(**{field: row[field]}).exclude(pk=row['keep'])
+            CartContent.objects.filter(cart__in=others).update(cart_id=row['keep'])
+            others.delete()
+
+    # Повторные позиции одного товара складываются в одну
+    duplicates = (CartContent.objects.values('cart_id', 'product_id')
+                  .annotate(n=Count('id'), keep=Min('id'), total=Sum('qty')).filter(n__gt=1))
+    for row in duplicates:
+        CartContent.objects.filter(pk=row['keep']).update(qty=row['total'])
+        CartContent.objects.filter(cart_id=row['cart_id'], product_id=row['product_id']).exclude(
+            pk=row['keep']).delete()
+
+    for cart in Cart.objects.annotate(
+            content_total=Sum(F('cartcontent__product__price') * F('cartcontent__qty'),
+                              output_field=models.DecimalField(max_digits=12, decimal_places=2)),
+            content_count=Count('cartcontent')).iterator():
+        cart.total_cost = cart.content_total or 0
+        cart.items_count = cart.content_count
+        cart.save(update_fields=['total_cost', 'items_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainpage', '0007_productratingsummary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='session_key',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user',), name='unique_cart_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('session_key',), name='unique_cart_session_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartcontent',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
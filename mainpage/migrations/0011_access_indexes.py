@@ -0,0 +1,72 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:05
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+import django.db.models.deletion
+
+
+def merge_duplicate_ratings(apps, schema_editor):
+    Rating = apps.get_model('mainpage', 'Rating')
+    ProductRatingSummary = apps.get_model('mainpage', 'ProductRatingSummary')
+
+    # Из повторных голосов с одного адреса за товар остается последний
+    duplicates = (Rating.objects.values('product_id', 'ip')
+                  .annotate(n=Count('id'), keep=Max('id')).filter(n__gt=1))
+    touched = set()
+    for row in duplicates.iterator():
+        Rating.objects.filter(product_id=row['product_id'], ip=row['ip']).exclude(pk=row['keep']).delete()
+        touched.add(row['product_id'])
+    if not touched:
+        return
+
+    summaries = {}
+    rows = (Rating.objects.filter(product_id__in=touched)
+            .values_list('product_id', 'star__value').annotate(n=Count('id')).order_by())
+    for product_id, value, n in rows.iterator():
+        summary = summaries.setdefault(product_id, ProductRatingSummary(product_id=product_id, histogram={}))
+        summary.histogram[str(value)] = n
+        summary.stars_sum += value * n
+        summary.votes += n
+    for summary in summaries.values():
+        summary.average = round(summary.stars_sum / summary.votes, 2)
+    ProductRatingSummary.objects.filter(product_id__in=touched).delete()
+    ProductRatingSummary.objects.bulk_create(summaries.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainpage', '0010_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='product',
+            index_together=set(),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_sale', '-id'], name='product_sale_id'),
+        ),
+        migrations.AlterField(
+            model_name='productratingsummary',
+            name='average',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=4, verbose_name='Средняя оценка'),
+        ),
+        migrations.AddIndex(
+            model_name='productratingsummary',
+            index=models.Index(fields=['-average', '-votes', 'product'], name='rating_summary_popular'),
+        ),
+        migrations.RunPython(merge_duplicate_ratings, migrations.RunPython.noop),
+        # Уникальный индекс создается раньше, чем удаляется индекс внешнего ключа:
+        # MySQL не дает оставить внешний ключ без индекса
+        migrations.AddConstraint(
+            model_name='rating',
+            constraint=models.UniqueConstraint(fields=('product', 'ip'), name='unique_rating_product_ip'),
+        ),
+        migrations.AlterField(
+            model_name='rating',
+            name='product',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mainpage.product', verbose_name='Продукт'),
+        ),
+    ]
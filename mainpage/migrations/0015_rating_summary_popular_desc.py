@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainpage', '0014_job'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='productratingsummary',
+            name='rating_summary_popular',
+        ),
+        migrations.AddIndex(
+            model_name='productratingsummary',
+            index=models.Index(fields=['-average', '-votes', '-product'], name='rating_summary_popular'),
+        ),
+    ]
@@ -1,13 +1,19 @@
+from decimal import Decimal
+
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Max, OuterRef, Prefetch, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.urls import reverse
+from django.utils import timezone
 
 
 class Category(models.Model):
     title = models.CharField(max_length=200, db_index=True, verbose_name='Название')
     description = models.TextField(verbose_name='Описание')
     slug = models.SlugField(max_length=255, unique=True, db_index=True, verbose_name="URL")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменена')
 
     def __str__(self):
         return self.title
@@ -25,6 +31,7 @@ class Author(models.Model):
     birth_day = models.DateField(verbose_name='Дата рождения', null=True, blank=True)
     about = models.TextField(verbose_name='Об авторе')
     slug = models.SlugField(max_length=255, unique=True, db_index=True, verbose_name="URL")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменен')
 
     def __str__(self):
         return self.name
@@ -34,15 +41,58 @@ class Author(models.Model):
         verbose_name_plural = 'Авторы'
 
 
+class ProductQuerySet(models.QuerySet):
+    # Поля, которые нужны карточке товара в списках
+    CARD_FIELDS = ('id', 'title', 'slug', 'img', 'img_variants', 'price',
+                   'author__id', 'author__name', 'author__slug')
+
+    def for_sale(self):
+        return self.filter(is_sale=True)
+
+    def with_rating(self):
+        return self.annotate(rating_avg=F('rating_summary__average'), rating_count=F('rating_summary__votes'))
+
+    def popular(self, limit):
+        """limit самых популярных товаров списком: оцененные, за ними остальные, новые первыми"""
+        # Оцененные читаются по индексу rating_summary_popular без сортировки. Последний ключ -
+        # product_id сводки, а не id товара: иначе БД досортировывает строки
+        products = list(self.filter(rating_summary__votes__gt=0).order_by(
+            '-rating_summary__average', '-rating_summary__votes', '-rating_summary__product')[:limit])
+        if len(products) < limit:
+            products += self.exclude(rating_summary__votes__gt=0).order_by('-id')[:limit - len(products)]
+        return products
+
+    def with_relations(self):
+        return self.select_related('author').prefetch_related(
+            Prefetch('cat', queryset=Category.objects.only('id', 'title', 'slug'))
+        )
+
+    def last_modified(self, **lookup):
+        """Последнее изменение товара, его автора, категорий и рейтинга одним запросом"""
+        times = self.filter(**lookup).aggregate(
+            Max('updated_at'), Max('author__updated_at'), Max('cat__updated_at'),
+            Max('rating_summary__updated_at'),
+        )
+        return max((value for value in times.values() if value is not None), default=None)
+
+    def catalogue(self):
+        """Товары в продаже для карточек: автор, категории и рейтинг за фиксированное число запросов"""
+        return self.for_sale().with_relations().with_rating().only(*self.CARD_FIELDS).order_by('-id')
+
+
 class Product(models.Model):
     title = models.CharField(max_length=100, verbose_name='Название')
     slug = models.SlugField(max_length=255, unique=True, db_index=True, verbose_name="URL")
     description = models.TextField(verbose_name='Описание')
     cat = models.ManyToManyField(Category, verbose_name='Категория')
     img = models.ImageField(upload_to='product/')
+    img_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name='Уменьшенные копии')
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Цена')
     author = models.ForeignKey(Author, on_delete=models.CASCADE, verbose_name='Автор')
     is_sale = models.BooleanField(default=True, verbose_name='В продаже')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменен')
+
+    objects = ProductQuerySet.as_manager()
 
     def __str__(self):
         return self.title
@@ -56,13 +106,36 @@ class Product(models.Model):
     class Meta:
         verbose_name = 'Продукт'
         verbose_name_plural = 'Продукты'
-        index_together = (('id', 'slug'),)
+        # Списки каталога: WHERE is_sale ORDER BY id DESC и keyset-курсоры по id
+        indexes = [
+            models.Index(fields=['is_sale', '-id'], name='product_sale_id'),
+        ]
+
+
+class SearchEntry(models.Model):
+    """Запись обратного индекса поиска: основа слова -> товар"""
+    term = models.CharField("Основа слова", max_length=64)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='search_entries',
+                                verbose_name="Продукт")
+    weight = models.PositiveSmallIntegerField("Вес", default=1)
+
+    def __str__(self):
+        return f"{self.term} - {self.product_id}"
+
+    class Meta:
+        verbose_name = "Запись поискового индекса"
+        verbose_name_plural = "Поисковый индекс"
+        # Покрывающий индекс: поиск по основе и префиксу читает только его
+        indexes = [
+            models.Index(fields=['term', 'product', 'weight'], name='search_term_covering'),
+        ]
 
 
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     date_of_birth = models.DateField(blank=True, null=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True)
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return 'Личный кабинет {}'.format(self.user.username)
@@ -89,14 +162,102 @@ class Rating(models.Model):
     """Рейтинг"""
     ip = models.CharField("IP адрес", max_length=15)
     star = models.ForeignKey(RatingStar, on_delete=models.CASCADE, verbose_name="Звезда")
-    product = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name="Продукт")
+    # Отдельный индекс не нужен: product - первая колонка уникального (product, ip)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_index=False, verbose_name="Продукт")
 
     def __str__(self):
         return f"{self.star} - {self.product}"
 
+    @classmethod
+    def vote(cls, ip, product_id, star):
+        """Ставит или меняет оценку и в той же транзакции сдвигает сводку товара"""
+        with transaction.atomic():
+            rating = cls.objects.select_for_update().select_related('star').filter(
+                ip=ip, product_id=product_id).first()
+            if rating is None:
+                old_value = None
+                rating = cls(ip=ip, product_id=product_id, star=star)
+            else:
+                old_value = rating.star.value
+                rating.star = star
+            # Сводка сдвигается здесь же, сигнал не пересчитывает ее заново
+            rating._summary_applied = True
+            if old_value is None:
+                rating.save(force_insert=True)
+            else:
+                rating.save(update_fields=['star'])
+            ProductRatingSummary.apply_vote(product_id, old_value, star.value)
+        return rating
+
     class Meta:
         verbose_name = "Рейтинг"
         verbose_name_plural = "Рейтинги"
+        # Один голос с адреса за товар; индекс же обслуживает поиск голоса в vote()
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'ip'], name='unique_rating_product_ip'),
+        ]
+
+
+class ProductRatingSummary(models.Model):
+    """Сводка рейтинга товара"""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='rating_summary', verbose_name="Продукт")
+    stars_sum = models.PositiveIntegerField("Сумма оценок", default=0)
+    votes = models.PositiveIntegerField("Кол-во оценок", default=0)
+    average = models.DecimalField("Средняя оценка", max_digits=4, decimal_places=2, default=0)
+    # {значение звезды: кол-во оценок}
+    histogram = models.JSONField("Распределение оценок", default=dict)
+    updated_at = models.DateTimeField("Изменена", auto_now=True)
+
+    def __str__(self):
+        return f"{self.product_id} - {self.average}"
+
+    def add(self, value, delta=1):
+        key = str(value)
+        self.histogram[key] = self.histogram.get(key, 0) + delta
+        if not self.histogram[key]:
+            del self.histogram[key]
+        self.stars_sum += value * delta
+        self.votes += delta
+        self.average = round(Decimal(self.stars_sum) / self.votes, 2) if self.votes else 0
+
+    @classmethod
+    def apply_vote(cls, product_id, old_value, new_value):
+        with transaction.atomic():
+            summary, _ = cls.objects.select_for_update().get_or_create(product_id=product_id)
+            if old_value is not None:
+                summary.add(old_value, -1)
+            summary.add(new_value)
+            summary.save()
+        return summary
+
+    @classmethod
+    def rebuild(cls, product_ids=None, batch_size=1000):
+        """Пересчитывает сводки с нуля по таблице Rating"""
+        ratings = Rating.objects.all()
+        summaries = cls.objects.all()
+        if product_ids is not None:
+            ratings = ratings.filter(product_id__in=product_ids)
+            summaries = summaries.filter(product_id__in=product_ids)
+
+        rebuilt = {}
+        rows = ratings.values_list('product_id', 'star__value').annotate(n=Count('id')).order_by()
+        for product_id, value, n in rows.iterator():
+            summary = rebuilt.setdefault(product_id, cls(product_id=product_id, histogram={}))
+            summary.add(value, n)
+
+        with transaction.atomic():
+            summaries.delete()
+            cls.objects.bulk_create(rebuilt.values(), batch_size=batch_size)
+        return len(rebuilt)
+
+    class Meta:
+        verbose_name = "Сводка рейтинга"
+        verbose_name_plural = "Сводки рейтинга"
+        # Порядок ProductQuerySet.popular()
+        indexes = [
+            models.Index(fields=['-average', '-votes', '-product'], name='rating_summary_popular'),
+        ]
 
 
 class Reviews(models.Model):
@@ -118,30 +279,89 @@ class Reviews(models.Model):
 
 
 class Cart(models.Model):
-    session_key = models.CharField(max_length=999, blank=True, default='')
+    session_key = models.CharField(max_length=40, null=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
-    total_cost = models.PositiveIntegerField()
+    total_cost = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='Сумма')
+    items_count = models.PositiveIntegerField(default=0, verbose_name='Кол-во позиций')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+    # Последнее изменение содержимого; UPDATE в mainpage/cart.py ставят его явно
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменена')
 
     def __str__(self):
         return str(self.id)
 
     def get_total(self):
-        items = CartContent.objects.filter(cart=self.id)
-        total = 0
-        for item in items:
-            total += item.product.price * item.qty
-        return total
+        return self.total_cost
 
     def get_cart_content(self):
-        cart_content = CartContent.objects.filter(cart=self.id)
+        cart_content = CartContent.objects.filter(cart=self.id).select_related('product')
         return cart_content
 
+    def recalculate(self):
+        """Пересчитывает агрегаты одним UPDATE по содержимому корзины"""
+        contents = CartContent.objects.filter(cart=OuterRef('pk')).values('cart')
+        Cart.objects.filter(pk=self.pk).update(
+            total_cost=Coalesce(Subquery(contents.annotate(
+                total=Sum(F('product__price') * F('qty'),
+                          output_field=models.DecimalField(max_digits=12, decimal_places=2))
+            ).values('total')), Value(0), output_field=models.DecimalField(max_digits=12, decimal_places=2)),
+            items_count=Coalesce(Subquery(contents.annotate(count=Count('id')).values('count')), Value(0)),
+            updated_at=timezone.now(),
+        )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], name='unique_cart_user'),
+            models.UniqueConstraint(fields=['session_key'], name='unique_cart_session_key'),
+        ]
+        indexes = [
+            # Поиск брошенных корзин в purge_carts
+            models.Index(fields=['updated_at'], name='cart_updated_at'),
+        ]
+
 
 class CartContent(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     qty = models.PositiveIntegerField(null=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
+
+class Job(models.Model):
+    """Фоновая задача, выполняется run_jobs (mainpage/jobs.py)"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'В очереди'), (RUNNING, 'Выполняется'), (FAILED, 'Ошибка')]
+
+    name = models.CharField('Функция', max_length=200)
+    args = models.JSONField('Аргументы', default=list)
+    kwargs = models.JSONField('Именованные аргументы', default=dict)
+    status = models.CharField('Статус', max_length=10, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField('Попыток', default=0)
+    max_attempts = models.PositiveSmallIntegerField('Максимум попыток', default=5)
+    run_at = models.DateTimeField('Запуск не раньше', default=timezone.now)
+    locked_at = models.DateTimeField('Взята', null=True, blank=True)
+    locked_by = models.CharField('Воркер', max_length=100, blank=True)
+    last_error = models.TextField('Последняя ошибка', blank=True)
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.name} #{self.pk}'
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        indexes = [
+            # Выборка следующей задачи воркером и поиск зависших
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at'),
+        ]
+
+
 # def clean_cart(self, response=None):
 #     cart_content = self.product.filter()
 #
@@ -0,0 +1,148 @@
+"""
+Отложенная запись оценок (RATING_WRITE_MODE = 'buffered').
+
+add-rating/ кладет голос в общий кэш под очередным номером и сразу отвечает
+202, не трогая таблицы рейтинга. flush_ratings раз в RATING_FLUSH_INTERVAL
+секунд забирает голоса по порядку номеров, оставляет последний голос каждой
+пары (ip, товар), записывает их одним INSERT ... ON DUPLICATE KEY UPDATE и
+пересчитывает сводки затронутых товаров по таблице Rating.
+
+Номер последнего записанного голоса сдвигается только после коммита: если
+flush упадет, те же голоса запишутся еще раз, а повторная запись ничего не
+меняет (at-least-once). Буфер живет в общем кэше и нужен процессам сайта и
+flush_ratings одновременно, поэтому SHARED_CACHE должен быть Redis.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+from .models import Product, ProductRatingSummary, Rating, RatingStar
+
+SEQUENCE_KEY = 'ratings:buffer:seq'
+DONE_KEY = 'ratings:buffer:done'
+VOTE_KEY = 'ratings:buffer:%d'
+LOCK_KEY = 'ratings:buffer:lock'
+# (ключ, время) первого пропуска, на котором остановился flush
+GAP_KEY = 'ratings:buffer:gap'
+# Голос хранится сутки: flush_ratings должен успеть его записать
+VOTE_TIMEOUT = 60 * 60 * 24
+# Номер голоса взят, а сам голос не записан: ждем писателя столько секунд,
+# потом считаем голос потерянным (процесс упал между incr и set)
+MISSING_GRACE = 30
+LOCK_TIMEOUT = 5 * 60
+
+
+def is_buffered():
+    return getattr(settings, 'RATING_WRITE_MODE', 'sync') == 'buffered'
+
+
+def get_buffer():
+    return caches[getattr(settings, 'RATING_BUFFER_CACHE', 'shared')]
+
+
+def next_sequence(buffer):
+    buffer.add(SEQUENCE_KEY, 0, None)
+    try:
+        return buffer.incr(SEQUENCE_KEY)
+    except ValueError:
+        buffer.set(SEQUENCE_KEY, 1, None)
+        return 1
+
+
+def enqueue(ip, product_id, star_id):
+    """Кладет голос в буфер, возвращает его номер"""
+    buffer = get_buffer()
+    while True:
+        seq = next_sequence(buffer)
+        # Время берется после incr: пропуск перед голосом старше MISSING_GRACE точно не заполнится
+        vote = (ip, product_id, star_id, time.time())
+        # add, а не set: если incr кэша не атомарен и номер достался двоим, второй берет следующий
+        if buffer.add(VOTE_KEY % seq, vote, VOTE_TIMEOUT):
+            return seq
+
+
+def take_ready(keys, found, now, gap=None):
+    """Ключи голосов, которые можно записать: до первого пропуска, который еще может заполниться
+
+    Пропуск потерян, если после него есть голос старше MISSING_GRACE или если
+    flush видит его дольше MISSING_GRACE (gap): так не застревает последний
+    номер, за которым новых голосов нет.
+    """
+    stale = -1
+    for i, key in enumerate(keys):
+        if key in found and found[key][3] < now - MISSING_GRACE:
+            stale = i
+    ready = []
+    for i, key in enumerate(keys):
+        if key not in found and i > stale and not (gap and gap[0] == key and gap[1] < now - MISSING_GRACE):
+            break
+        ready.append(key)
+    return ready
+
+
+def apply_votes(votes, batch_size=1000):
+    """Записывает голоса (ip, товар, звезда, время), возвращает кол-во записанных оценок"""
+    latest = {}
+    # Голоса идут в порядке номеров, последний голос пары перекрывает прежние
+    for ip, product_id, star_id, _ in votes:
+        latest[ip, product_id] = star_id
+    products = set(Product.objects.filter(pk__in={product_id for _, product_id in latest})
+                   .values_list('pk', flat=True))
+    stars = set(RatingStar.objects.filter(pk__in=set(latest.values())).values_list('pk', flat=True))
+    # Порядок уникального индекса: параллельные вставки берут блокировки в одном порядке
+    ratings = [Rating(ip=ip, product_id=product_id, star_id=star_id)
+               for (ip, product_id), star_id in sorted(latest.items())
+               if product_id in products and star_id in stars]
+    if not ratings:
+        return 0
+    unique_fields = None
+    if connection.features.supports_update_conflicts_with_target:
+        unique_fields = ['product', 'ip']
+    with transaction.atomic():
+        Rating.objects.bulk_create(ratings, batch_size=batch_size, update_conflicts=True,
+                                   unique_fields=unique_fields, update_fields=['star'])
+        ProductRatingSummary.rebuild({rating.product_id for rating in ratings}, batch_size=batch_size)
+    return len(ratings)
+
+
+def flush(batch_size=1000):
+    """Записывает голоса из буфера, возвращает (прочитано голосов, записано оценок)"""
+    buffer = get_buffer()
+    if not buffer.add(LOCK_KEY, 1, LOCK_TIMEOUT):
+        return 0, 0
+    read = written = 0
+    try:
+        seq = buffer.get(SEQUENCE_KEY) or 0
+        done = buffer.get(DONE_KEY) or 0
+        gap = buffer.get(GAP_KEY)
+        if seq < done:
+            # Счетчик вытеснен из кэша и начат заново
+            done, gap = 0, None
+        while done < seq:
+            keys = [VOTE_KEY % n for n in range(done + 1, min(seq, done + batch_size) + 1)]
+            found = buffer.get_many(keys)
+            now = time.time()
+            ready = take_ready(keys, found, now, gap)
+            if len(ready) < len(keys) and (not gap or gap[0] != keys[len(ready)]):
+                # Номер взят раньше, чем flush впервые увидел пропуск, отсчет грации - отсюда
+                gap = (keys[len(ready)], now)
+                buffer.set(GAP_KEY, gap, None)
+            if not ready:
+                break
+            written += apply_votes([found[key] for key in ready if key in found], batch_size)
+            done += len(ready)
+            buffer.set(DONE_KEY, done, None)
+            buffer.delete_many(ready)
+            read += len(ready)
+            if len(ready) < len(keys):
+                break
+    finally:
+        buffer.delete(LOCK_KEY)
+    return read, written
+
+
+def pending():
+    buffer = get_buffer()
+    return max((buffer.get(SEQUENCE_KEY) or 0) - (buffer.get(DONE_KEY) or 0), 0)
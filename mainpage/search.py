@@ -0,0 +1,165 @@
+"""
+Поиск по каталогу: обратный индекс SearchEntry по названию, описанию,
+автору и категориям товара с русским стеммингом (алгоритм Портера).
+"""
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from .models import Product, SearchEntry
+
+# Вес слова в зависимости от поля, в котором оно встретилось
+FIELD_WEIGHTS = (
+    ('title', 8),
+    ('author', 4),
+    ('categories', 2),
+    ('description', 1),
+)
+MAX_WEIGHT = 100
+MAX_TERM_LENGTH = 64
+MIN_PREFIX_LENGTH = 2
+# Сколько разных основ может дать префикс последнего слова: иначе короткий
+# префикс превращается в GROUP BY по большой части индекса
+MAX_PREFIX_TERMS = 50
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(r'[а-я]')
+
+# Стеммер Портера для русского языка
+RVRE = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+PERFECTIVE_GERUND = re.compile(r'((?<=[ая])(в|вши|вшись)|(ив|ивши|ившись|ыв|ывши|ывшись))$')
+REFLEXIVE = re.compile(r'(ся|сь)$')
+ADJECTIVE = re.compile(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+PARTICIPLE = re.compile(r'((?<=[ая])(ем|нн|вш|ющ|щ)|(ивш|ывш|ующ))$')
+VERB = re.compile(r'((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)|'
+                  r'(ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|'
+                  r'ить|ыть|ишь|ую|ю))$')
+NOUN = re.compile(r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|'
+                  r'ию|ью|ю|ия|ья|я)$')
+DERIVATIONAL = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+SUPERLATIVE = re.compile(r'(ейше|ейш)$')
+
+
+def stem(word):
+    word = word.lower().replace('ё', 'е')
+    if not CYRILLIC_RE.search(word):
+        return word
+    match = RVRE.match(word)
+    if not match:
+        return word
+    start, rv = match.groups()
+
+    step = PERFECTIVE_GERUND.sub('', rv, 1)
+    if step == rv:
+        rv = REFLEXIVE.sub('', rv, 1)
+        step = ADJECTIVE.sub('', rv, 1)
+        if step != rv:
+            rv = PARTICIPLE.sub('', step, 1)
+        else:
+            step = VERB.sub('', rv, 1)
+            rv = NOUN.sub('', rv, 1) if step == rv else step
+    else:
+        rv = step
+
+    rv = re.sub('и$', '', rv)
+    if DERIVATIONAL.match(rv):
+        rv = re.sub('ость?$', '', rv)
+    step = re.sub('ь$', '', rv)
+    if step == rv:
+        rv = SUPERLATIVE.sub('', rv, 1)
+        rv = re.sub('нн$', 'н', rv)
+    else:
+        rv = step
+    return start + rv
+
+
+def tokenize(text):
+    return [word for word in WORD_RE.findall((text or '').lower()) if len(word) > 1 or word.isdigit()]
+
+
+def terms(text):
+    return [stem(word)[:MAX_TERM_LENGTH] for word in tokenize(text)]
+
+
+def build_entries(product):
+    fields = {
+        'title': product.title,
+        'author': product.author.name,
+        'categories': ' '.join(cat.title for cat in product.cat.all()),
+        'description': product.description,
+    }
+    weights = Counter()
+    for field, weight in FIELD_WEIGHTS:
+        for term in terms(fields[field]):
+            weights[term] += weight
+    return [SearchEntry(term=term, product_id=product.pk, weight=min(weight, MAX_WEIGHT))
+            for term, weight in weights.items()]
+
+
+def index_products(products, batch_size=1000):
+    """Переиндексирует товары: удаляет их записи и вставляет заново"""
+    products = list(products)
+    if not products:
+        return 0
+    entries = []
+    for product in products:
+        entries.extend(build_entries(product))
+    with transaction.atomic():
+        SearchEntry.objects.filter(product_id__in=[product.pk for product in products]).delete()
+        SearchEntry.objects.bulk_create(entries, batch_size=batch_size)
+    return len(entries)
+
+
+def indexable_products():
+    return Product.objects.select_related('author').prefetch_related('cat').order_by('pk')
+
+
+def reindex(product_ids):
+    return index_products(indexable_products().filter(pk__in=list(product_ids)))
+
+
+def expand_prefix(prefix):
+    """Первые MAX_PREFIX_TERMS основ с префиксом prefix, по покрывающему индексу"""
+    # istartswith: startswith в MySQL - LIKE BINARY, который не читает индекс по диапазону
+    # в сопоставлении столбца; основы уже в нижнем регистре, результат тот же
+    return list(SearchEntry.objects.filter(term__istartswith=prefix).order_by('term')
+                .values_list('term', flat=True).distinct()[:MAX_PREFIX_TERMS])
+
+
+def search_ids(query, limit=200):
+    """id товаров в продаже по убыванию релевантности; последнее слово ищется по префиксу"""
+    words = terms(query)
+    if not words:
+        return []
+    *exact, last = words
+    exact = set(exact) - {last}
+    if len(last) >= MIN_PREFIX_LENGTH:
+        last_match = Q(term__in=expand_prefix(last))
+    else:
+        last_match = Q(term=last)
+    # Снятые с продажи отсекаются до LIMIT, иначе они съедают места в выдаче
+    entries = SearchEntry.objects.filter(product__is_sale=True)
+    # Товар должен содержать все слова запроса, последнее - хотя бы как префикс основы
+    if exact:
+        entries = (entries.filter(Q(term__in=exact) | last_match).values('product')
+                   .alias(exact_matched=Count('term', filter=Q(term__in=exact)),
+                          last_matched=Count('term', filter=last_match))
+                   .filter(exact_matched=len(exact), last_matched__gt=0))
+    else:
+        entries = entries.filter(last_match).values('product')
+    ranked = entries.annotate(score=Sum('weight')).order_by('-score', '-product')[:limit]
+    return [row['product'] for row in ranked]
+
+
+def search(query, limit=200):
+    ids = search_ids(query, limit)
+    products = Product.objects.catalogue().filter(pk__in=ids).in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
+
+
+def suggest(prefix, limit=8):
+    ids = search_ids(prefix, limit)
+    products = Product.objects.for_sale().only('id', 'title', 'slug').in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
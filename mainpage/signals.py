@@ -0,0 +1,79 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import tasks
+from .cache import bump_catalogue_version
+from .cart import merge_cookie_cart
+from .images import needs_variants
+from .models import Author, Category, Product, ProductRatingSummary, Rating, UserProfile
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Author)
+def catalogue_changed(sender, **kwargs):
+    bump_catalogue_version()
+
+
+@receiver(m2m_changed, sender=Product.cat.through)
+def product_categories_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_catalogue_version()
+
+
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def rating_edited(sender, instance, origin=None, **kwargs):
+    # Оценки, измененные в обход Rating.vote (админка, delete() queryset),
+    # пересчитываются по таблице Rating; сводка удаляемого товара удалится вместе с ним
+    if getattr(instance, '_summary_applied', False) or isinstance(origin, Product):
+        return
+    if getattr(origin, 'model', None) is Product:
+        return
+    ProductRatingSummary.rebuild([instance.product_id])
+
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    if request is None:
+        return
+    cart = merge_cookie_cart(request, user)
+    if cart is not None:
+        request.merged_cart = cart
+
+
+# Индекс поиска и уменьшенные копии картинок обновляются фоновыми задачами,
+# чтобы сохранение в админке не ждало их
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    tasks.reindex_products.delay([instance.pk])
+
+
+@receiver(m2m_changed, sender=Product.cat.through)
+def index_product_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        tasks.reindex_products.delay(sorted(pk_set or ()) if reverse else [instance.pk])
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Category)
+def index_related_products(sender, instance, created, **kwargs):
+    if not created:
+        tasks.reindex_related_products.delay(instance._meta.label_lower, instance.pk)
+
+
+@receiver(post_save, sender=Product)
+def build_product_variants(sender, instance, **kwargs):
+    if needs_variants(instance, 'img', 'img_variants'):
+        tasks.refresh_image_variants.delay(instance._meta.label_lower, instance.pk, 'img', 'img_variants')
+
+
+@receiver(post_save, sender=UserProfile)
+def build_avatar_variants(sender, instance, **kwargs):
+    if needs_variants(instance, 'avatar', 'avatar_variants'):
+        tasks.refresh_image_variants.delay(instance._meta.label_lower, instance.pk, 'avatar', 'avatar_variants')
@@ -1,7 +1,7 @@
 // Add star rating
 const rating = document.querySelector('form[name=rating]');
 
-rating.addEventListener("change", function (e) {
+rating && rating.addEventListener("change", function (e) {
     // Получаем данные из формы
     let data = new FormData(this);
     fetch(`${this.action}`, {
@@ -10,4 +10,19 @@ rating.addEventListener("change", function (e) {
     })
         .then(response => alert("Рейтинг установлен"))
         .catch(error => alert("Ошибка"))
-});
\ No newline at end of file
+});
+
+// Подсказки поиска
+const searchInput = document.querySelector('input[data-suggest-url]');
+
+searchInput && searchInput.addEventListener("input", function (e) {
+    if (this.value.length < 2) {
+        return;
+    }
+    fetch(`${this.dataset.suggestUrl}?q=${encodeURIComponent(this.value)}`)
+        .then(response => response.json())
+        .then(data => {
+            const list = document.getElementById(this.getAttribute('list'));
+            list.replaceChildren(...data.results.map(item => new Option(item.title)));
+        })
+});
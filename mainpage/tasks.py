@@ -0,0 +1,30 @@
+"""Фоновые задачи каталога (mainpage/jobs.py), ставятся в очередь сигналами"""
+from django.apps import apps
+
+from . import search
+from .cache import bump_catalogue_version
+from .images import refresh_variants
+from .jobs import job
+from .models import Product
+
+
+@job
+def refresh_image_variants(model_label, pk, image_field, variants_field):
+    instance = apps.get_model(model_label).objects.filter(pk=pk).first()
+    if instance is None:
+        return
+    if refresh_variants(instance, image_field, variants_field) and isinstance(instance, Product):
+        bump_catalogue_version()
+
+
+@job
+def reindex_products(product_ids):
+    search.reindex(product_ids)
+
+
+@job
+def reindex_related_products(model_label, pk):
+    """Товары автора или категории после их изменения"""
+    instance = apps.get_model(model_label).objects.filter(pk=pk).first()
+    if instance is not None:
+        search.reindex(instance.product_set.values_list('pk', flat=True))
@@ -1,5 +1,13 @@
+from functools import lru_cache
+
 from django import template
+from django.templatetags.static import static
+from django.urls import get_script_prefix, reverse
+from django.utils.html import format_html, format_html_join
+
+from ..images import FORMATS
 from ..models import *
+from ..utils import get_cached_categories
 
 register = template.Library()
 
@@ -7,16 +15,84 @@ register = template.Library()
 @register.simple_tag(name='getcats')
 def get_categories(filter=None):
     if not filter:
-        return Category.objects.all()
+        return get_cached_categories()
     else:
-        return Category.objects.filter(pk=filter)
+        return [c for c in get_cached_categories() if c.pk == filter]
 
 
 @register.inclusion_tag('mainpage/list_categories.html')
 def show_categories(sort=None, cat_selected=0):
-    if not sort:
-        cats = Category.objects.all()
-    else:
-        cats = Category.objects.order_by(sort)
+    cats = get_cached_categories(sort)
 
     return {"cats": cats, "cat_selected": cat_selected}
+
+
+# Адреса статики и страниц без параметров не меняются, пока процесс жив:
+# манифест статики читается при старте, а URLconf не меняется
+
+
+@lru_cache(maxsize=None)
+def get_static_url(path):
+    return static(path)
+
+
+@lru_cache(maxsize=None)
+def _reverse(name, script_prefix):
+    return reverse(name)
+
+
+def get_url(name):
+    return _reverse(name, get_script_prefix())
+
+
+@register.simple_tag(name='cached_static')
+def cached_static(path):
+    """{% static %}, вычисленный один раз на процесс"""
+    return get_static_url(path)
+
+
+@register.simple_tag(name='cached_url')
+def cached_url(name):
+    """{% url %} для адреса без параметров, вычисленный один раз на процесс"""
+    return get_url(name)
+
+
+@register.inclusion_tag('mainpage/product_cards.html', takes_context=True)
+def product_cards(context, products):
+    """Карточки списка товаров за один рендер: адреса и иконки считаются один раз на список"""
+    return {
+        'products': products,
+        'csrf_token': context.get('csrf_token'),
+        'catalogue_version': context.get('catalogue_version'),
+        'fragment_timeout': context.get('fragment_timeout'),
+        'cart_url': get_url('cart'),
+        'stars_icon': get_static_url('mainpage/img/icon/Stars.svg'),
+        'cart_icon': get_static_url('mainpage/img/icon/ShoppingCartSimple.svg'),
+    }
+
+
+@register.simple_tag(name='responsive_img')
+def responsive_image(image, variants, sizes='100vw', **attrs):
+    """<picture> с srcset из уменьшенных копий картинки; без копий - обычный <img>"""
+    if not image:
+        return ''
+    formats = (variants or {}).get('formats', {}) if (variants or {}).get('source') == image.name else {}
+    storage = image.storage
+
+    def srcset(fmt):
+        return ', '.join(f"{storage.url(v['name'])} {v['width']}w" for v in formats[fmt])
+
+    img_attrs = {'src': image.url, 'loading': 'lazy', **attrs}
+    if formats.get('jpeg'):
+        img_attrs['srcset'] = srcset('jpeg')
+        img_attrs['sizes'] = sizes
+    if variants and variants.get('width'):
+        img_attrs.setdefault('width', variants['width'])
+        img_attrs.setdefault('height', variants['height'])
+    img = format_html('<img{}>', format_html_join('', ' {}="{}"', img_attrs.items()))
+
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((FORMATS[fmt][1], srcset(fmt), sizes) for fmt in ('avif', 'webp') if formats.get(fmt)),
+    )
+    return format_html('<picture>{}{}</picture>', sources, img)
@@ -1,3 +1,460 @@
-from django.test import TestCase
+import io
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import cart as cart_service
+from . import admin as shop_admin
+from . import catalogue_feed, jobs, metrics, ratings, search
+from .images import refresh_variants, variant_names
+from .management.commands import purge_carts
+from .models import (Author, Cart, CartContent, Category, Job, Product, ProductRatingSummary, Rating, RatingStar,
+                     SearchEntry)
+
+
+@jobs.job(max_attempts=2)
+def failing_job(message):
+    raise ValueError(message)
+
+
+@jobs.job(stale_after=60 * 60)
+def slow_job():
+    pass
+
+
+def make_catalogue(products=3):
+    author = Author.objects.create(name='Толстой', slug='tolstoy', about='Писатель')
+    category = Category.objects.create(title='Роман', slug='roman', description='Романы')
+    for value in range(1, 6):
+        RatingStar.objects.create(value=value)
+    result = []
+    for i in range(products):
+        product = Product.objects.create(title=f'Война и мир {i}', slug=f'war-{i}', description='Книга о войне',
+                                         price=Decimal('10.50') + i, author=author, img=f'product/book{i}.png')
+        product.cat.add(category)
+        result.append(product)
+    return result
+
+
+class RatingSummaryTests(TestCase):
+    def setUp(self):
+        self.product = make_catalogue(1)[0]
+        self.stars = {star.value: star for star in RatingStar.objects.all()}
+
+    def get_summary(self):
+        return ProductRatingSummary.objects.get(product=self.product)
+
+    def test_vote_updates_summary(self):
+        Rating.vote('1.1.1.1', self.product.pk, self.stars[5])
+        Rating.vote('2.2.2.2', self.product.pk, self.stars[3])
+        Rating.vote('2.2.2.2', self.product.pk, self.stars[4])
+        summary = self.get_summary()
+        self.assertEqual((summary.votes, summary.stars_sum), (2, 9))
+        self.assertEqual(summary.histogram, {'5': 1, '4': 1})
+
+    def test_rating_edited_directly(self):
+        rating = Rating.vote('1.1.1.1', self.product.pk, self.stars[5])
+        Rating.vote('2.2.2.2', self.product.pk, self.stars[3])
+        rating = Rating.objects.get(pk=rating.pk)
+        rating.star = self.stars[1]
+        rating.save()
+        self.assertEqual(self.get_summary().stars_sum, 4)
+        Rating.objects.filter(ip='2.2.2.2').delete()
+        summary = self.get_summary()
+        self.assertEqual((summary.votes, summary.stars_sum), (1, 1))
+        Rating.objects.all().delete()
+        self.assertFalse(ProductRatingSummary.objects.filter(product=self.product).exists())
+
+    def test_popular_keeps_unrated_last(self):
+        rated, unrated = [Product.objects.create(title=f'Книга {i}', slug=f'book-{i}', description='',
+                                                 price=Decimal('1'), author=self.product.author) for i in range(2)]
+        Rating.vote('1.1.1.1', self.product.pk, self.stars[5])
+        Rating.vote('1.1.1.1', rated.pk, self.stars[3])
+        self.assertEqual(Product.objects.popular(10), [self.product, rated, unrated])
+        self.assertEqual(Product.objects.popular(1), [self.product])
+
+    def test_product_deleted_with_ratings(self):
+        Rating.vote('1.1.1.1', self.product.pk, self.stars[5])
+        self.product.delete()
+        self.assertFalse(ProductRatingSummary.objects.exists())
+
+
+@override_settings(RATING_WRITE_MODE='buffered', RATING_BUFFER_CACHE='buffer', CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'buffer': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ratings-tests'},
+})
+class BufferedRatingTests(TestCase):
+    def setUp(self):
+        self.products = make_catalogue(2)
+        self.stars = {star.value: star.pk for star in RatingStar.objects.all()}
+        ratings.get_buffer().clear()
+
+    def test_last_vote_of_pair_wins(self):
+        first, second = self.products
+        for value in (1, 3, 5):
+            ratings.enqueue('1.1.1.1', first.pk, self.stars[value])
+        ratings.enqueue('2.2.2.2', first.pk, self.stars[2])
+        ratings.enqueue('1.1.1.1', second.pk, self.stars[4])
+        self.assertEqual(ratings.flush(), (5, 3))
+        self.assertEqual(Rating.objects.get(ip='1.1.1.1', product=first).star_id, self.stars[5])
+        summary = ProductRatingSummary.objects.get(product=first)
+        self.assertEqual((summary.votes, summary.stars_sum), (2, 7))
+        self.assertEqual(ratings.pending(), 0)
+
+    def test_failed_flush_is_replayed(self):
+        ratings.enqueue('1.1.1.1', self.products[0].pk, self.stars[4])
+        with mock.patch.object(ProductRatingSummary, 'rebuild', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                ratings.flush()
+        self.assertFalse(Rating.objects.exists())
+        self.assertEqual(ratings.pending(), 1)
+        self.assertEqual(ratings.flush(), (1, 1))
+        self.assertEqual(ProductRatingSummary.objects.get(product=self.products[0]).votes, 1)
+
+    def test_lost_last_vote_times_out(self):
+        ratings.enqueue('1.1.1.1', self.products[0].pk, self.stars[4])
+        ratings.next_sequence(ratings.get_buffer())  # процесс упал между incr и add
+        self.assertEqual(ratings.flush(), (1, 1))
+        self.assertEqual(ratings.pending(), 1)
+        later = ratings.time.time() + ratings.MISSING_GRACE + 1
+        with mock.patch.object(ratings.time, 'time', return_value=later):
+            self.assertEqual(ratings.flush(), (1, 0))
+        self.assertEqual(ratings.pending(), 0)
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        make_catalogue()
+
+    def test_bad_cursor_is_first_page(self):
+        first_page = self.client.get(reverse('product_list')).context['product']
+        for cursor in ('²', 'abc', str(2 ** 64)):
+            response = self.client.get(reverse('product_list'), {'after': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(response.context['product']), list(first_page))
+
+    @override_settings(PAGE_CACHE_TIMEOUT=3600)
+    def test_vote_keeps_page_cache(self):
+        product = Product.objects.first()
+        url = product.get_absolute_url()
+        self.client.get(url)
+        etag = self.client.get(url)['ETag']
+        Rating.vote('1.1.1.1', product.pk, RatingStar.objects.get(value=5))
+        # Только запрос Last-Modified, без рендера
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_bad_cart_count_cookie(self):
+        self.client.cookies['cart_count'] = '²'
+        self.assertEqual(self.client.get(reverse('mainpage')).status_code, 200)
+
+
+class QueryBudgetTests(TestCase):
+    """Запросов к БД на страницу без кэша; рост числа - N+1 или лишний запрос в виде"""
+
+    def setUp(self):
+        self.products = make_catalogue(products=10)
+        for alias in ('default', 'shared'):
+            caches[alias].clear()
+
+    def get(self, url, budget):
+        with metrics.query_budget(budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_home(self):
+        # Популярных без оценок нет, их место занимают неоцененные: еще запрос и prefetch категорий
+        self.get(reverse('mainpage'), 6)
+
+    def test_product_list(self):
+        self.get(reverse('product_list'), 4)
+
+    def test_product_detail(self):
+        self.get(self.products[0].get_absolute_url(), 4)
+
+    def test_cart_add(self):
+        user = User.objects.create_user('reader', password='secret')
+        cart_service.get_user_cart(user.pk)
+        self.client.force_login(user)
+        for product in self.products[:2]:
+            # SAVEPOINT и RELEASE вокруг atomic тоже считаются
+            with metrics.query_budget(8):
+                response = self.client.post(reverse('cart'), {'p_id': product.pk, 'qty': 1})
+            self.assertEqual(response.status_code, 302)
+
+
+    def test_server_timing_details_for_staff(self):
+        response = self.client.get(reverse('mainpage'))
+        self.assertNotIn('queries', response['Server-Timing'])
+        self.client.force_login(User.objects.create_user('admin', password='secret', is_staff=True))
+        response = self.client.get(reverse('mainpage'))
+        self.assertIn('queries', response['Server-Timing'])
+
+
+class AdminChangeListTests(TestCase):
+
+    def setUp(self):
+        self.products = make_catalogue(products=10)
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+
+    @mock.patch.object(shop_admin, 'COUNT_LIMIT', 3)
+    def test_count_reaches_past_limit(self):
+        queryset = Product.objects.filter(title__startswith='Война').order_by('pk')
+        self.assertEqual(shop_admin.EstimatedCountPaginator(queryset, 2).count, 3)
+        paginator = shop_admin.EstimatedCountPaginator(queryset, 2, page_number=3)
+        self.assertEqual(paginator.count, 7)
+        self.assertEqual(len(paginator.page(4).object_list), 1)
+
+    def test_search_by_id(self):
+        product = self.products[1]
+        response = self.client.get(reverse('admin:mainpage_product_changelist'), {'q': product.pk})
+        # Кроме самого товара находятся только товары с этим числом в названии
+        expected = [p for p in self.products if p == product or str(product.pk) in p.title]
+        self.assertCountEqual(response.context['cl'].result_list, expected)
+
+
+class CookieCartTests(TestCase):
+    def setUp(self):
+        self.products = make_catalogue()
+
+    def add(self, product, qty=1):
+        return self.client.post(reverse('cart'), {'p_id': product.pk, 'qty': qty})
+
+    @override_settings(CART_ANONYMOUS_MODE='cookie')
+    @mock.patch.object(cart_service, 'CART_COOKIE_MAX_ITEMS', 2)
+    def test_full_cart_shows_error(self):
+        self.add(self.products[0])
+        self.add(self.products[1])
+        self.assertRedirects(self.add(self.products[2]), reverse('cart'), fetch_redirect_response=False)
+        page = self.client.get(reverse('cart'))
+        self.assertContains(page, 'В корзине уже 2 товаров')
+        self.assertEqual(cart_service.CookieCart.from_request(page.wsgi_request).items,
+                         {self.products[0].pk: 1, self.products[1].pk: 1})
+
+    @override_settings(CART_ANONYMOUS_MODE='cookie')
+    def test_login_adds_cookie_quantities(self):
+        user = User.objects.create_user('reader', password='secret')
+        cart = cart_service.get_user_cart(user.pk)
+        cart_service.set_qty(cart, self.products[0].pk, 2)
+        self.add(self.products[0], 3)
+        self.add(self.products[1], 1)
+        request = self.client.get(reverse('cart')).wsgi_request
+        cart_service.merge_cookie_cart(request, user)
+        contents = dict(CartContent.objects.filter(cart=cart).values_list('product_id', 'qty'))
+        self.assertEqual(contents, {self.products[0].pk: 5, self.products[1].pk: 1})
+        cart.refresh_from_db()
+        total = 5 * self.products[0].price + self.products[1].price
+        self.assertEqual((cart.items_count, cart.total_cost), (2, total))
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        self.products = make_catalogue()
+        self.cart = Cart.objects.create(session_key='visitor')
+
+    def statements(self, func, *args):
+        """Запросы операции без BEGIN/SAVEPOINT/RELEASE"""
+        with CaptureQueriesContext(connection) as ctx:
+            func(self.cart, *args)
+        return [query['sql'].split()[0] for query in ctx.captured_queries
+                if not query['sql'].startswith(('SAVEPOINT', 'RELEASE', 'BEGIN'))]
+
+    def assertTotals(self, items_count, total_cost):
+        self.assertEqual(self.cart.items_count, items_count)
+        self.assertEqual(self.cart.total_cost, total_cost)
+        self.cart.recalculate()
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.items_count, self.cart.total_cost), (items_count, total_cost))
+
+    def test_add(self):
+        first, second = self.products[0], self.products[1]
+        self.assertEqual(self.statements(cart_service.add, first.pk, 2), ['UPDATE', 'UPDATE', 'INSERT'])
+        self.assertEqual(self.statements(cart_service.add, first.pk, 1), ['UPDATE', 'UPDATE'])
+        cart_service.add(self.cart, second.pk)
+        self.assertTotals(2, first.price * 3 + second.price)
+
+    def test_set_qty_and_remove(self):
+        first, second = self.products[0], self.products[1]
+        cart_service.set_qty(self.cart, first.pk, 2)
+        cart_service.set_qty(self.cart, second.pk, 1)
+        self.assertEqual(self.statements(cart_service.set_qty, first.pk, 5), ['UPDATE', 'UPDATE'])
+        self.assertTotals(2, first.price * 5 + second.price)
+        self.assertEqual(self.statements(cart_service.remove, first.pk), ['UPDATE', 'DELETE'])
+        cart_service.remove(self.cart, first.pk)
+        self.assertTotals(1, second.price)
+
+
+class PurgeCartsTests(TestCase):
+
+    def test_cart_changed_after_select_survives(self):
+        old = timezone.now() - timedelta(days=30)
+        stale, touched = Cart.objects.create(session_key='a'), Cart.objects.create(session_key='b')
+        Cart.objects.filter(pk__in=[stale.pk, touched.pk]).update(updated_at=old)
+        atomic = transaction.atomic
+
+        def touch_then_atomic(*args, **kwargs):
+            # Посетитель меняет корзину между выборкой pk и удалением
+            Cart.objects.filter(pk=touched.pk).update(updated_at=timezone.now())
+            return atomic(*args, **kwargs)
+
+        with mock.patch.object(transaction, 'atomic', touch_then_atomic):
+            deleted = purge_carts.purge(cart_service.expired_anonymous_carts(60), batch_size=10, pause=0)
+        self.assertEqual(deleted, 1)
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [touched.pk])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.products = make_catalogue()
+        search.reindex([product.pk for product in self.products])
+
+    def test_not_for_sale_does_not_take_places(self):
+        Product.objects.filter(pk__in=[self.products[2].pk, self.products[1].pk]).update(is_sale=False)
+        self.assertEqual(search.search_ids('война', limit=1), [self.products[0].pk])
+        self.assertEqual([product.pk for product in search.suggest('вой', limit=1)], [self.products[0].pk])
+
+    @mock.patch.object(search, 'MAX_PREFIX_TERMS', 1)
+    def test_prefix_expansion_is_capped(self):
+        SearchEntry.objects.create(term='восток', product=self.products[0])
+        self.assertEqual(search.expand_prefix('во'), ['войн'])
+
+
+def make_png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (200, 300), color).save(buffer, 'PNG')
+    return ContentFile(buffer.getvalue())
+
+
+@override_settings(IMAGE_VARIANT_WIDTHS=(50, 100), IMAGE_VARIANT_FORMATS=('jpeg',))
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.products = make_catalogue(2)
+
+    def set_image(self, product, color):
+        product.img.save('cover.png', make_png(color))
+        refresh_variants(product, 'img', 'img_variants')
+        return variant_names(product.img_variants)
+
+    def test_rebuild_deletes_previous_variants(self):
+        old = self.set_image(self.products[0], 'red')
+        self.assertTrue(all(default_storage.exists(name) for name in old))
+        new = self.set_image(self.products[0], 'blue')
+        self.assertFalse(old & new)
+        self.assertFalse(any(default_storage.exists(name) for name in old))
+        self.assertTrue(all(default_storage.exists(name) for name in new))
+
+    def test_shared_variants_are_kept(self):
+        shared = self.set_image(self.products[0], 'red')
+        self.assertEqual(self.set_image(self.products[1], 'red'), shared)
+        self.set_image(self.products[0], 'blue')
+        self.assertTrue(all(default_storage.exists(name) for name in shared))
+
+
+class CatalogueImportTests(TestCase):
+    def test_bad_lines_are_skipped(self):
+        feed = io.StringIO('\n'.join([
+            '{"kind": "category", "slug": "roman", "title": "Роман"}',
+            '{"kind": "author", "slug": "tolstoy", "name": "Лев Толстой"}',
+            '{bad json',
+            '[1, 2]',
+            '{"slug": 5, "kind": "product", "title": "Без цены", "author": "tolstoy"}',
+            '{"slug": "war", "title": "Война и мир", "price": "990.00", "author": "tolstoy", "categories": ["roman"]}',
+        ]))
+        importer = catalogue_feed.import_records(catalogue_feed.read_records(feed, 'jsonl'), reindex=False)
+        self.assertEqual([line for line, _ in importer.errors], [3, 4, 5])
+        self.assertIn('JSONDecodeError', importer.errors[0][1])
+        self.assertEqual(list(Product.objects.values_list('slug', flat=True)), ['war'])
+        self.assertEqual(list(Product.objects.get().cat.values_list('slug', flat=True)), ['roman'])
+
+    def test_invalid_values_are_row_errors(self):
+        product = '{"slug": "%s", "title": "%s", "price": "%s", "author": "tolstoy"}'
+        feed = io.StringIO('\n'.join([
+            '{"kind": "author", "slug": "tolstoy", "name": "Лев Толстой"}',
+            product % ('big', 'Книга', '1e20'),
+            product % ('nan', 'Книга', 'NaN'),
+            product % ('negative', 'Книга', '-5'),
+            product % ('война и мир', 'Книга', '10'),
+            product % ('long', 'К' * 101, '10'),
+            product % ('war', 'Война и мир', '990.00'),
+        ]))
+        importer = catalogue_feed.import_records(catalogue_feed.read_records(feed, 'jsonl'), reindex=False)
+        self.assertEqual([line for line, _ in importer.errors], [2, 3, 4, 5, 6])
+        self.assertEqual(list(Product.objects.values_list('slug', flat=True)), ['war'])
+
+
+@override_settings(JOB_RUNNER='db')
+class JobTests(TestCase):
+    def test_claim(self):
+        task = failing_job.delay('boom')
+        Job.objects.create(name=task.name, run_at=timezone.now() + timedelta(minutes=1))
+        claimed = jobs.claim('worker-1')
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (task.pk, Job.RUNNING, 1))
+        self.assertIsNone(jobs.claim('worker-2'))
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.locked_by), (Job.RUNNING, 'worker-1'))
+
+    def test_failure_backs_off_then_fails(self):
+        task = failing_job.delay('boom')
+        self.assertFalse(jobs.execute(jobs.claim('worker')))
+        task.refresh_from_db()
+        self.assertEqual(task.status, Job.QUEUED)
+        self.assertIn('ValueError: boom', task.last_error)
+        self.assertGreater(task.run_at, timezone.now() + timedelta(seconds=jobs.BACKOFF_BASE * 0.8 - 1))
+        self.assertIsNone(jobs.claim('worker'))
+        Job.objects.filter(pk=task.pk).update(run_at=timezone.now())
+        self.assertFalse(jobs.execute(jobs.claim('worker')))
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Job.FAILED, 2))
+
+    def test_success_deletes(self):
+        slow_job.delay()
+        self.assertTrue(jobs.execute(jobs.claim('worker')))
+        self.assertFalse(Job.objects.exists())
+
+    def test_result_not_written_after_requeue(self):
+        task = slow_job.delay()
+        claimed = jobs.claim('dead')
+        Job.objects.filter(pk=task.pk).update(locked_by='alive')
+        self.assertTrue(jobs.execute(claimed))
+        self.assertEqual(Job.objects.get().locked_by, 'alive')
+
+    @override_settings(JOB_RUNNER='inline')
+    def test_inline_failure_is_logged(self):
+        with self.assertLogs('mainpage.jobs', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            failing_job.delay('boom')
+        with self.assertRaises(TypeError):
+            failing_job.delay(object())
+
+    def test_unregistered_function_fails(self):
+        Job.objects.create(name='os.remove', args=['/tmp/x'], max_attempts=1)
+        self.assertFalse(jobs.execute(jobs.claim('worker')))
+        self.assertIn('LookupError', Job.objects.get().last_error)
+
+    def test_requeue_stale(self):
+        long_ago = timezone.now() - timedelta(seconds=jobs.STALE_AFTER + 60)
+        running = {'status': Job.RUNNING, 'locked_at': long_ago, 'locked_by': 'dead'}
+        retried = Job.objects.create(name=failing_job.job_name, attempts=1, max_attempts=2, **running)
+        exhausted = Job.objects.create(name=failing_job.job_name, attempts=2, max_attempts=2, **running)
+        slow = Job.objects.create(name=slow_job.job_name, attempts=1, **running)
+        self.assertEqual(jobs.requeue_stale(), 2)
+        statuses = dict(Job.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {retried.pk: Job.QUEUED, exhausted.pk: Job.FAILED, slow.pk: Job.RUNNING})
@@ -1,13 +1,31 @@
+from django.conf import settings
 from django.urls import path
 from django.views.decorators.cache import cache_page
 
 from . import views
 
+# Под ASGI страницы каталога и корзины обслуживают асинхронные виды
+if settings.ASYNC_VIEWS:
+    from . import async_views
+    main_page = async_views.main_page
+    product_list = async_views.product_list
+    product_detail = async_views.product_detail
+    product_category = async_views.product_category
+    cart = async_views.cart_view
+else:
+    main_page = views.MainPage.as_view()
+    product_list = views.ProductList.as_view()
+    product_detail = views.ProductDetail.as_view()
+    product_category = views.ProductCategory.as_view()
+    cart = views.CartView.as_view()
+
 urlpatterns = [
-    path('', views.MainPage.as_view(), name='mainpage'),
-    path('products', views.ProductList.as_view(), name='product_list'),
-    path('product/<slug:product_slug>/', views.ProductDetail.as_view(), name='product_det'),
-    path('category/<slug:cat_slug>/', views.ProductCategory.as_view(), name='category'),
+    path('', main_page, name='mainpage'),
+    path('products', product_list, name='product_list'),
+    path('product/<slug:product_slug>/', product_detail, name='product_det'),
+    path('category/<slug:cat_slug>/', product_category, name='category'),
+    path('search/', views.SearchView.as_view(), name='search'),
+    path('search/suggest/', views.search_suggest, name='search_suggest'),
     path('add-book', views.AddProduct.as_view(), name='add_product'),
     path('reg/', views.RegisterUser.as_view(), name='reg'),
     path('login/', views.LoginUser.as_view(), name='login'),
@@ -15,6 +33,7 @@ urlpatterns = [
     path('add-rating/', views.AddStarRating.as_view(), name='add_rating'),
     path('profile/', views.view_profile, name='profile'),
     path('edit-profile/', views.edit_profile, name="edit_profile"),
-    path('cart/', views.CartView.as_view(), name='cart'),
+    path('cart/', cart, name='cart'),
     path('clean-cart/', views.CleanCart.as_view(), name='clean_cart'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
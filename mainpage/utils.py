@@ -1,14 +1,163 @@
+import hashlib
+
 from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+
+from .cache import (CART_COUNT_PLACEHOLDER, CSRF_TOKEN_PLACEHOLDER, cached, fill_page_placeholders,
+                    get_not_modified, get_page_timeout, is_conditional, is_page_cacheable, make_page_etag,
+                    make_page_key, patch_page_validators)
 from .models import Category
 
+# Курсор пагинации - id товара, больше BIGINT он быть не может
+MAX_CURSOR = 2 ** 63 - 1
+
+
+def get_cached_categories(sort=None):
+    ordering = sort or 'pk'
+    return cached('categories', ordering, producer=lambda: list(Category.objects.order_by(ordering)))
+
 
 class DataMixin:
     paginate_by = 5
 
     def get_user_context(self, **kwargs):
         context = kwargs
-        cats = Category.objects.all()
+        cats = get_cached_categories()
         context['cats'] = cats
         if 'cat_selected' not in context:
             context['cat_selected'] = 0
         return context
+
+
+class KeysetPage:
+    """Страница keyset-пагинации: курсоры вместо номера страницы"""
+    is_keyset = True
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginationMixin:
+    """Пагинация по id (?after=/?before=) без COUNT(*) и OFFSET.
+
+    Список отсортирован по убыванию id, страница N стоит столько же, сколько
+    первая. Общее число записей считается только при keyset_count = True и
+    кэшируется до следующего изменения каталога.
+    """
+    keyset_count = False
+
+    def get_cursor(self, name):
+        return get_cursor(self.request, name)
+
+    def get_approximate_count(self, queryset):
+        return get_approximate_count(queryset)
+
+    def paginate_queryset(self, queryset, page_size):
+        count = self.get_approximate_count(queryset) if self.keyset_count else None
+        page = paginate_keyset(queryset, page_size, self.get_cursor('after'), self.get_cursor('before'), count)
+        return None, page, page.object_list, page.has_other_pages()
+
+
+def get_cursor(request, name):
+    """id товара из параметра запроса; кривой курсор - первая страница"""
+    value = request.GET.get(name, '')
+    # isdecimal, а не isdigit: int() не разбирает надстрочные цифры вроде "²"
+    if not value.isdecimal() or int(value) > MAX_CURSOR:
+        return None
+    return int(value)
+
+
+def get_approximate_count(queryset):
+    query_hash = hashlib.md5(str(queryset.order_by().query).encode()).hexdigest()
+    return cached('count', query_hash, producer=queryset.order_by().count)
+
+
+def paginate_keyset(queryset, page_size, after=None, before=None, count=None):
+    if before is not None:
+        rows = list(queryset.filter(pk__gt=before).order_by('pk')[:page_size + 1])
+        has_previous, has_next = len(rows) > page_size, True
+        rows = rows[:page_size][::-1]
+    else:
+        if after is not None:
+            queryset = queryset.filter(pk__lt=after)
+        rows = list(queryset.order_by('-pk')[:page_size + 1])
+        has_previous, has_next = after is not None, len(rows) > page_size
+        rows = rows[:page_size]
+
+    return KeysetPage(
+        rows,
+        next_cursor=rows[-1].pk if has_next and rows else None,
+        previous_cursor=rows[0].pk if has_previous and rows else None,
+        count=count,
+    )
+
+
+class PageCacheMixin:
+    """Кэш целой страницы для анонимных GET-запросов.
+
+    Страница рендерится один раз с плейсхолдерами вместо CSRF-токена и
+    cart_count, персональные значения подставляются при каждой отдаче.
+    """
+    page_cache_render = False
+
+    def get_last_modified(self):
+        """Время изменения содержимого страницы для Last-Modified, если известно"""
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_conditional(request):
+            return self.get_page_response(request, *args, **kwargs)
+        etag, last_modified = make_page_etag(request), self.get_last_modified()
+        response = get_not_modified(request, etag, last_modified)
+        if response is None:
+            response = self.get_page_response(request, *args, **kwargs)
+            if response.status_code == 200:
+                patch_page_validators(response, etag, last_modified)
+        return response
+
+    def get_page_response(self, request, *args, **kwargs):
+        if not is_page_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        key = make_page_key(request)
+        content = cache.get(key)
+        if content is not None:
+            response = HttpResponse(fill_page_placeholders(request, content))
+            response['X-Page-Cache'] = 'hit'
+        else:
+            self.page_cache_render = True
+            response = super().dispatch(request, *args, **kwargs)
+            if response.status_code != 200 or not hasattr(response, 'render'):
+                return response
+            content = response.render().content.decode(response.charset)
+            cache.set(key, content, get_page_timeout())
+            response.content = fill_page_placeholders(request, content)
+            response['X-Page-Cache'] = 'miss'
+        patch_cache_control(response, private=True)
+        return response
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if self.page_cache_render:
+            context['csrf_token'] = CSRF_TOKEN_PLACEHOLDER
+            context['cart_count'] = CART_COUNT_PLACEHOLDER
+        return context
@@ -1,14 +1,21 @@
+from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import LoginView
-from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse
+from django.db import IntegrityError
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
 from django.views import View
 from django.views.generic import ListView, DetailView, CreateView, UpdateView
 from django.contrib.auth.mixins import LoginRequiredMixin
 
+from . import cart as cart_service
+from . import metrics
+from . import ratings
+from . import search
+from .cart import CART_COOKIE, CookieCart, uses_cookie_cart
 from .forms import *
 from .models import *
 from .utils import *
@@ -18,83 +25,115 @@ class MasterView(View):
 
     def get_cart_records(self, cart=None, response=None):
         cart = self.get_cart() if cart is None else cart
-        if cart is not None:
-            cart_records = CartContent.objects.filter(cart_id=cart.id)
-        else:
-            cart_records = []
 
         if response:
-            response.set_cookie('cart_count', len(cart_records))
+            response.set_cookie('cart_count', cart.items_count if cart is not None else 0)
+            if isinstance(cart, CookieCart):
+                cart.save(response)
             return response
 
+        if cart is not None:
+            cart_records = cart.get_cart_content()
+        else:
+            cart_records = []
+
         return cart_records
 
     def get_cart(self):
+        if uses_cookie_cart(self.request):
+            return CookieCart.from_request(self.request)
         if self.request.user.is_authenticated:
-            user_id = self.request.user.id
-            try:
-                cart = Cart.objects.get(user_id=user_id)
-            except ObjectDoesNotExist:
-                cart = Cart(user_id=user_id,
-                            total_cost=0)
-                cart.save()
-        else:
+            return cart_service.get_user_cart(self.request.user.id)
+        session_key = self.request.session.session_key
+        if not session_key:
+            self.request.session.save()
             session_key = self.request.session.session_key
-            if not session_key:
-                self.request.session.save()
-                session_key = self.request.session.session_key
-            try:
-                cart = Cart.objects.get(session_key=session_key)
-            except ObjectDoesNotExist:
-                cart = Cart(session_key=session_key,
-                            total_cost=0)
-                cart.save()
-
-        return cart
+        return cart_service.get_session_cart(session_key)
 
 
-class MainPage(MasterView, DataMixin, ListView):
+class MainPage(PageCacheMixin, KeysetPaginationMixin, MasterView, DataMixin, ListView):
     model = Product
     template_name = 'mainpage/mainpage.html'
     context_object_name = 'product'
     extra_context = {'title': 'AB книжный магазин'}
 
     def get_queryset(self):
-        return Product.objects.filter(is_sale=True)
+        return Product.objects.catalogue()
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['popular'] = Product.objects.catalogue().popular(self.paginate_by)
+        return context
 
 
-class ProductList(MasterView, DataMixin, ListView):
+class ProductList(PageCacheMixin, KeysetPaginationMixin, MasterView, DataMixin, ListView):
     model = Product
     template_name = 'mainpage/products.html'
     context_object_name = 'product'
     extra_context = {'title': 'Новинки'}
+    keyset_count = True
 
     def get_queryset(self):
-        return Product.objects.filter(is_sale=True)
+        return Product.objects.catalogue()
 
 
-class ProductCategory(DataMixin, ListView):
+class ProductCategory(PageCacheMixin, KeysetPaginationMixin, DataMixin, ListView):
     model = Product
     template_name = 'mainpage/products.html'
     context_object_name = 'product'
     allow_empty = False
+    keyset_count = True
 
     def get_queryset(self):
-        return Product.objects.filter(cat__slug=self.kwargs['cat_slug'], is_sale=True)
+        self.category = get_object_or_404(Category, slug=self.kwargs['cat_slug'])
+        return Product.objects.catalogue().filter(cat=self.category)
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        c_def = self.get_user_context(title='Категория - ' + str(context['product'][0].cat),
-                                      cat_selected=context['product'][0].cat)
+        c_def = self.get_user_context(title='Категория - ' + self.category.title,
+                                      cat_selected=self.category.pk)
         return dict(list(context.items()) + list(c_def.items()))
 
 
-class ProductDetail(DetailView):
+class SearchView(PageCacheMixin, DataMixin, ListView):
+    template_name = 'mainpage/products.html'
+    context_object_name = 'product'
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()[:100]
+        return search.search(self.query) if self.query else []
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        c_def = self.get_user_context(title='Поиск', search_query=self.query)
+        return dict(list(context.items()) + list(c_def.items()))
+
+
+def metrics_view(request):
+    """Метрики процесса в текстовом формате Prometheus"""
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1',))
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in allowed):
+        raise Http404
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def search_suggest(request):
+    products = search.suggest(request.GET.get('q', '').strip()[:100])
+    return JsonResponse({'results': [{'title': p.title, 'url': p.get_absolute_url()} for p in products]})
+
+
+class ProductDetail(PageCacheMixin, DetailView):
     model = Product
     template_name = 'mainpage/product_detail.html'
     slug_url_kwarg = 'product_slug'
     context_object_name = 'product'
 
+    def get_queryset(self):
+        return Product.objects.with_relations().with_rating()
+
+    def get_last_modified(self):
+        return Product.objects.last_modified(slug=self.kwargs['product_slug'])
+
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = context['product']
@@ -171,13 +210,11 @@ def edit_profile(request):
 
 
 def log_out(request):
+    cart_service.forget(request)
     logout(request)
     response = redirect('/')
-    cart_content = CartContent.objects.all()
-    if response:
-        response.delete_cookie('cart_count')
-        cart_content.delete()
-        return response
+    response.delete_cookie('cart_count')
+    response.delete_cookie(CART_COOKIE)
     return response
 
 
@@ -195,10 +232,15 @@ class AddStarRating(View):
     def post(self, request):
         form = RatingForm(request.POST)
         if form.is_valid():
-            Rating.objects.update_or_create(
+            if ratings.is_buffered():
+                ratings.enqueue(self.get_client_ip(request), int(request.POST.get("product")),
+                                form.cleaned_data['star'].pk)
+                # Голос принят, в БД его запишет flush_ratings
+                return HttpResponse(status=202)
+            Rating.vote(
                 ip=self.get_client_ip(request),
                 product_id=int(request.POST.get("product")),
-                defaults={'star_id': int(request.POST.get("star"))}
+                star=form.cleaned_data['star'],
             )
             return HttpResponse(status=201)
         else:
@@ -207,9 +249,9 @@ class AddStarRating(View):
 
 class CleanCart(MasterView):
     def get(self, request):
-        cart_rec = self.get_cart_records()
-        cart_rec.delete()
-        return redirect('/cart/')
+        cart = self.get_cart()
+        cart_service.clear(cart)
+        return self.get_cart_records(cart, redirect('/cart/'))
 
 
 class CartView(MasterView):
@@ -221,18 +263,25 @@ class CartView(MasterView):
         context = {
             'cart_records': cart_records,
             'cart_total': cart_total,
+            'cart_count': cart.items_count if cart else 0,
         }
         return render(request, 'mainpage/cart.html', context)
 
     def post(self, request):
-        product = Product.objects.get(id=request.POST.get('p_id'))
+        try:
+            product_id = int(request.POST.get('p_id'))
+            quantity = int(request.POST.get('qty') or 1)
+        except (TypeError, ValueError):
+            return HttpResponse(status=400)
         cart = self.get_cart()
-        quantity = request.POST.get('qty')
-        # get_or_create - найдет обьект, если его нет в базе, то создаст
-        # первый параметр - обьект, второй - булевое значение которое сообщает создан ли обьект
-        # если обьект создан, то True, если он уже имеется в базе, то False
-        cart_content, _ = CartContent.objects.get_or_create(cart=cart, product=product)
-        cart_content.qty = quantity
-        cart_content.save()
-        response = self.get_cart_records(cart, redirect('/#product-{}'.format(product.id)))
+        # одна транзакция: UPDATE/INSERT позиции и сдвиг суммы и кол-ва позиций корзины
+        try:
+            cart_service.set_qty(cart, product_id, quantity)
+        except (Product.DoesNotExist, IntegrityError):
+            raise Http404
+        except cart_service.CartFull:
+            messages.error(request, f'В корзине уже {cart_service.CART_COOKIE_MAX_ITEMS} товаров. '
+                                    'Войдите, чтобы добавить больше.')
+            return redirect('cart')
+        response = self.get_cart_records(cart, redirect('/#product-{}'.format(product_id)))
         return response